@@ -0,0 +1,161 @@
+"""Модуль с кэшами в памяти процесса"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+# Маркер отсутствия значения (None тоже может быть закэширован)
+_MISSING = object()
+
+
+class RequestCoalescer:
+    """Объединение одинаковых одновременных запросов (single-flight)"""
+
+    def __init__(self):
+        self._inflight = {}  # key -> Future запроса, который сейчас выполняется
+        self.calls = 0
+        self.coalesced = 0
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполняет запрос или присоединяется к уже выполняющемуся с тем же ключом
+
+        Args:
+            key: ключ запроса (одинаковые ключи - одинаковые запросы)
+            factory: корутина-функция без аргументов, выполняющая запрос
+
+        Returns:
+            Результат запроса (общий объект для всех объединенных вызовов)
+        """
+        future = self._inflight.get(key)
+
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(factory())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(future)
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Возвращает статистику объединения запросов
+
+        Returns:
+            Словарь со статистикой
+        """
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._inflight)
+        }
+
+
+class TTLCache:
+    """LRU кэш ограниченного размера с временем жизни записей"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        Инициализация
+
+        Args:
+            maxsize: максимальное количество записей (старые вытесняются по LRU)
+            ttl: время жизни записи в секундах по умолчанию
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._loads = RequestCoalescer()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Возвращает значение из кэша или default, если записи нет или она устарела"""
+        item = self._data.get(key)
+
+        if item is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Сохраняет значение (ttl - собственное время жизни записи в секундах)"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]],
+                          cache_if: Optional[Callable[[Any], bool]] = None) -> Any:
+        """
+        Возвращает значение из кэша, при промахе загружает его через loader
+
+        Одновременные промахи по одному ключу объединяются: loader вызывается
+        один раз, остальные вызовы ждут его результат.
+
+        Args:
+            key: ключ кэша
+            loader: корутина-функция без аргументов, возвращающая значение
+            cache_if: условие сохранения результата в кэш (по умолчанию сохраняется всегда)
+
+        Returns:
+            Значение из кэша или результат loader
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        return await self._loads.run(key, lambda: self._load(key, loader, cache_if))
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]],
+                    cache_if: Optional[Callable[[Any], bool]]) -> Any:
+        """Загружает значение и сохраняет его в кэш"""
+        value = await loader()
+        if cache_if is None or cache_if(value):
+            self.set(key, value)
+        return value
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Удаляет запись из кэша"""
+        item = self._data.pop(key, None)
+        return item[1] if item is not None else default
+
+    def clear(self):
+        """Очищает кэш"""
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        item = self._data.get(key)
+        return item is not None and item[0] > time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Возвращает статистику кэша
+
+        Returns:
+            Словарь со статистикой
+        """
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self._loads.coalesced
+        }
@@ -6,6 +6,7 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 DB_NAME = 'bot_database.db'
+DB_BUSY_TIMEOUT = 5  # Сколько секунд ждать освобождения блокировки SQLite
 
 # Ключ шифрования для API ключей (32 байта base64)
 # Если не указан в .env, будет сгенерирован автоматически
@@ -14,6 +15,68 @@ ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY')
 # WB API endpoints
 WB_API_DISCOUNTS_URL = 'https://discounts-prices-api.wildberries.ru'
 
+# Пул HTTP соединений к WB API (общий для всех запросов процесса)
+WB_HTTP_POOL_LIMIT = 100            # Всего одновременных соединений
+WB_HTTP_POOL_LIMIT_PER_HOST = 20    # Соединений на один хост
+WB_HTTP_KEEPALIVE_TIMEOUT = 60      # Сколько секунд держать простаивающее соединение
+WB_HTTP_DNS_CACHE_TTL = 300         # Время жизни DNS кэша в секундах
+
+# Cards API: размер пачки nmID в одном запросе и число параллельных запросов
+WB_CARDS_BATCH_SIZE = 100
+WB_CARDS_MAX_CONCURRENCY = 5
+
+# Лимиты запросов к WB: {хост: (запросов в секунду, размер всплеска)}
+# Для Discounts-Prices API лимит считается на каждый API ключ отдельно
+WB_RATE_LIMITS = {
+    'discounts-prices-api.wildberries.ru': (10 / 6, 5),
+    'card.wb.ru': (10, 20),
+}
+WB_RATE_LIMIT_DEFAULT = (5, 10)
+
+# Повторы запросов при 429 / 5xx / ошибках соединения
+WB_RETRY_ATTEMPTS = 3               # Сколько раз повторять запрос
+WB_RETRY_BASE_DELAY = 0.5           # Начальная задержка в секундах (удваивается с каждой попыткой)
+WB_RETRY_MAX_DELAY = 30             # Максимальная задержка; если WB просит ждать дольше - не повторяем
+
+# Кэш данных Cards API по nmID (общий для всех пользователей и ключей)
+WB_CARDS_CACHE_TTL = 300            # Время жизни записи в секундах
+WB_CARDS_CACHE_MAX_SIZE = 100000    # Максимум товаров в кэше
+
+# Discounts-Prices API: размер страницы listGoods и сколько следующих страниц запрашивать заранее
+WB_GOODS_PAGE_SIZE = 1000
+WB_GOODS_PREFETCH_PAGES = 2
+
+# Кэш списков товаров дефолтных ключей (общий для всех подписчиков)
+DEFAULT_GOODS_CACHE_TTL = 60        # Время жизни в секундах
+
+# Кэш загруженных Excel файлов комиссий (общий для всех пользователей)
+EXCEL_CACHE_MAX_BYTES = 200 * 1024 * 1024   # Примерный бюджет памяти
+EXCEL_PARSE_WORKERS = 2                     # Процессов для разбора загруженных файлов
+
+# Параллельная обработка API ключей при поиске товаров
+KEYS_MAX_CONCURRENCY = 20           # Всего ключей одновременно (на весь бот)
+KEYS_MAX_CONCURRENCY_PER_USER = 4   # Ключей одновременно для одного пользователя
+
+# Кэш состояния подписки по user_id (общий для всех экземпляров Database)
+SUBSCRIPTION_CACHE_TTL = 60             # Сколько секунд помнить активную подписку (не дольше end_date)
+SUBSCRIPTION_CACHE_NEGATIVE_TTL = 10    # Сколько секунд помнить отсутствие подписки
+SUBSCRIPTION_CACHE_MAX_SIZE = 100000    # Максимум пользователей в кэше
+
+# Кэш расшифрованных API ключей по id ключа (общий для всех экземпляров Database)
+API_KEYS_CACHE_TTL = 3600           # Время жизни записи в секундах
+API_KEYS_CACHE_MAX_SIZE = 10000     # Максимум ключей в кэше
+
+# Результаты поиска для пагинации (сжатые страницы)
+# memory - в памяти процесса; sqlite - в файле RESULT_STORE_PATH (переживает перезапуск,
+# общий для нескольких процессов бота)
+RESULT_STORE_BACKEND = os.getenv('RESULT_STORE_BACKEND', 'memory')
+RESULT_STORE_PATH = os.getenv('RESULT_STORE_PATH', 'results.db')
+RESULT_STORE_TTL = 6 * 3600                 # Сколько секунд хранить результаты пользователя
+RESULT_STORE_MAX_BYTES = 64 * 1024 * 1024   # Бюджет памяти на результаты всех пользователей (memory)
+# Максимальная длина одной части страницы результатов в UTF-16 code units
+# (лимит Telegram - 4096, запас оставлен под возможные изменения заголовка)
+RESULT_PAGE_MAX_LENGTH = 3900
+
 # Дефолтные API ключи (доступны всем пользователям)
 DEFAULT_API_KEYS = [
     os.getenv('DEFAULT_API_KEY_1'),
@@ -1,17 +1,249 @@
 """Модуль для работы с базой данных"""
+import asyncio
 import aiosqlite
-from config import DB_NAME
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Optional
+from cache_helper import TTLCache, _MISSING
+from config import (
+    DB_NAME, DB_BUSY_TIMEOUT, API_KEYS_CACHE_TTL, API_KEYS_CACHE_MAX_SIZE,
+    SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_CACHE_NEGATIVE_TTL, SUBSCRIPTION_CACHE_MAX_SIZE
+)
 from crypto_helper import CryptoHelper
 
+# Версионные миграции схемы: (версия, список SQL). Применяются по порядку,
+# номер последней примененной хранится в PRAGMA user_version
+MIGRATIONS = [
+    (1, [
+        # Активная подписка пользователя: WHERE user_id = ? AND status = 'active' AND end_date > ?
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_user_status_end ON subscriptions(user_id, status, end_date)',
+        # Истекающие подписки: MAX(id) ... WHERE status = 'active' GROUP BY user_id
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_status_user_id ON subscriptions(status, user_id, id)',
+        # Истекающие подписки: WHERE status = 'active' AND end_date BETWEEN ...
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_status_end ON subscriptions(status, end_date)',
+        # Ключи пользователя: WHERE user_id = ? AND is_active = 1 ORDER BY id
+        'CREATE INDEX IF NOT EXISTS idx_api_keys_user_active ON api_keys(user_id, is_active, id)',
+        # Платежи пользователя: WHERE user_id = ? ORDER BY created_at DESC
+        'CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments(user_id, created_at)',
+        # Карты пользователя: WHERE user_id = ? AND is_active = 1 ORDER BY created_at DESC
+        'CREATE INDEX IF NOT EXISTS idx_payment_methods_user_active ON payment_methods(user_id, is_active, created_at)',
+        # Ссылки на общий Excel файл: WHERE excel_file_path = ?
+        'CREATE INDEX IF NOT EXISTS idx_users_excel_file_path ON users(excel_file_path)',
+    ]),
+]
+
+
+# Горячие запросы (используют индексы из MIGRATIONS, планы проверяет test_db_indexes.py)
+
+# Активная подписка пользователя: параметры (user_id, now)
+ACTIVE_SUBSCRIPTION_QUERY = '''SELECT id, plan_id, start_date, end_date
+    FROM subscriptions
+    WHERE user_id = ? AND status = 'active' AND end_date > ?
+    ORDER BY end_date DESC LIMIT 1'''
+
+# Последние активные подписки пользователей, истекающие в интервале: параметры (now, future_date)
+EXPIRING_SUBSCRIPTIONS_QUERY = '''SELECT user_id, plan_id, end_date
+    FROM subscriptions
+    WHERE status = 'active'
+      AND end_date > ?
+      AND end_date <= ?
+      AND id IN (
+          SELECT MAX(id)
+          FROM subscriptions
+          WHERE status = 'active'
+          GROUP BY user_id
+      )
+    ORDER BY end_date ASC'''
+
+# Пользователь, активная подписка и активные ключи одним запросом: параметры {user_id, now}
+USER_CONTEXT_QUERY = '''SELECT u.discount_threshold, u.use_default_keys, u.excel_file_path, u.excel_file_name,
+           s.id, s.plan_id, s.start_date, s.end_date,
+           k.id, k.key_name, k.api_key
+    FROM (SELECT :user_id AS user_id) p
+    LEFT JOIN users u ON u.user_id = p.user_id
+    LEFT JOIN subscriptions s ON s.id = (
+        SELECT id FROM subscriptions
+        WHERE user_id = p.user_id AND status = 'active' AND end_date > :now
+        ORDER BY end_date DESC LIMIT 1
+    )
+    LEFT JOIN api_keys k ON k.user_id = p.user_id AND k.is_active = 1
+    ORDER BY k.id'''
+
+# Активные API ключи пользователя: параметры (user_id,)
+ACTIVE_API_KEYS_QUERY = 'SELECT id, key_name, api_key FROM api_keys WHERE user_id = ? AND is_active = 1 ORDER BY id'
+
+# Последние платежи пользователя: параметры (user_id, limit)
+USER_PAYMENTS_QUERY = '''SELECT payment_id, plan_id, amount, status, paid, created_at
+    FROM payments
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+    LIMIT ?'''
+
+# Активные карты пользователя: параметры (user_id,)
+USER_PAYMENT_METHODS_QUERY = '''SELECT id, payment_method_id, payment_method_type, card_last4, card_first6,
+           card_type, card_expiry_month, card_expiry_year, created_at
+    FROM payment_methods
+    WHERE user_id = ? AND is_active = 1
+    ORDER BY created_at DESC'''
+
+# Количество пользователей, ссылающихся на Excel файл: параметры (file_path,)
+EXCEL_FILE_REFERENCES_QUERY = 'SELECT COUNT(*) FROM users WHERE excel_file_path = ?'
+
+
+# Порог скидки и флаг дефолтных ключей для пользователей без записи в users
+DEFAULT_DISCOUNT_THRESHOLD = 28
+DEFAULT_USE_DEFAULT_KEYS = True
+
+# Активная подписка по user_id (dict или None), общий для всех экземпляров Database.
+# Сбрасывается методами, которые создают, продлевают или отменяют подписки.
+subscription_cache = TTLCache(maxsize=SUBSCRIPTION_CACHE_MAX_SIZE, ttl=SUBSCRIPTION_CACHE_TTL)
+
+
+def cache_subscription(user_id: int, subscription: Optional[dict]):
+    """
+    Запоминает активную подписку пользователя (None - подписки нет)
+
+    Активная подписка хранится не дольше SUBSCRIPTION_CACHE_TTL и не дольше
+    ее end_date, отсутствие подписки - SUBSCRIPTION_CACHE_NEGATIVE_TTL.
+    """
+    if subscription is None:
+        subscription_cache.set(user_id, None, ttl=SUBSCRIPTION_CACHE_NEGATIVE_TTL)
+        return
+
+    ttl = SUBSCRIPTION_CACHE_TTL
+    try:
+        end_date = subscription['end_date']
+        if not isinstance(end_date, datetime):
+            end_date = datetime.fromisoformat(str(end_date))
+        ttl = min(ttl, (end_date - datetime.now()).total_seconds())
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    if ttl > 0:
+        subscription_cache.set(user_id, subscription, ttl=ttl)
+
+
+def invalidate_subscription(user_id: int):
+    """Сбрасывает закэшированную подписку пользователя"""
+    subscription_cache.pop(user_id)
+
+
+# Расшифрованные API ключи: key_id -> (зашифрованный ключ, расшифрованный ключ).
+# Запись используется, только если шифртекст в БД совпадает с сохраненным,
+# поэтому измененный в обход Database ключ не будет выдан из кэша.
+api_key_cache = TTLCache(maxsize=API_KEYS_CACHE_MAX_SIZE, ttl=API_KEYS_CACHE_TTL)
+
+
+def invalidate_api_key(key_id: int):
+    """Удаляет расшифрованный ключ из кэша"""
+    api_key_cache.pop(key_id)
+
+
+@dataclass
+class UserContext:
+    """Все, что нужно для поиска товаров, одним объектом"""
+    user_id: int
+    has_subscription: bool
+    subscription_end_date: Optional[str]
+    discount_threshold: int
+    use_default_keys: bool
+    excel_file_path: Optional[str]
+    excel_file_name: Optional[str]
+    api_keys: list = field(default_factory=list)  # активные ключи, включая дефолтные
+
+    @property
+    def excel_file(self) -> tuple[str, str] | None:
+        """(путь, имя) Excel файла, как в Database.get_excel_file"""
+        if self.excel_file_path:
+            return self.excel_file_path, self.excel_file_name
+        return None
+
+
+def with_default_keys(user_keys: list, use_defaults: bool) -> list:
+    """
+    Добавляет дефолтные (системные) ключи перед ключами пользователя
+
+    Args:
+        user_keys: активные ключи пользователя
+        use_defaults: включены ли дефолтные ключи
+
+    Returns:
+        Список ключей с флагом is_default
+    """
+    from config import DEFAULT_API_KEYS
+
+    all_keys = []
+
+    # Сначала добавляем дефолтные ключи (если включены, они не видны пользователю)
+    if use_defaults:
+        for idx, default_key in enumerate(DEFAULT_API_KEYS, 1):
+            all_keys.append({
+                'id': f'default_{idx}',  # Специальный ID для дефолтных ключей
+                'name': f'Системный ключ {idx}',
+                'key': default_key,
+                'is_default': True  # Флаг что это дефолтный ключ
+            })
+
+    # Затем добавляем пользовательские ключи
+    for key in user_keys:
+        key['is_default'] = False
+        all_keys.append(key)
+
+    return all_keys
+
 
 class Database:
     def __init__(self, db_name: str = DB_NAME):
         self.db_name = db_name
         self.crypto = CryptoHelper()
+        # Одно долгоживущее соединение на экземпляр (открывается при первом обращении)
+        self._connection = None
+        # Запросы через одно соединение выполняются по очереди, чтобы транзакции не смешивались
+        self._lock = asyncio.Lock()
+
+    async def _open(self) -> aiosqlite.Connection:
+        """Открывает соединение, если оно еще не открыто"""
+        if self._connection is None:
+            connection = await aiosqlite.connect(self.db_name, timeout=DB_BUSY_TIMEOUT)
+            # WAL: чтение не блокируется записью; NORMAL достаточно для WAL и быстрее FULL
+            await connection.execute('PRAGMA journal_mode=WAL')
+            await connection.execute('PRAGMA synchronous=NORMAL')
+            await connection.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}')
+            self._connection = connection
+        return self._connection
+
+    async def connect(self):
+        """Открывает соединение с базой данных (вызывается при старте бота)"""
+        async with self._lock:
+            await self._open()
+
+    async def close(self):
+        """Закрывает соединение с базой данных (при остановке бота)"""
+        async with self._lock:
+            if self._connection is not None:
+                await self._connection.close()
+                self._connection = None
+
+    @asynccontextmanager
+    async def _connect(self):
+        """
+        Выдает общее соединение на время блока запросов
+
+        Незафиксированные изменения блока, завершившегося ошибкой, откатываются,
+        чтобы их не зафиксировал следующий блок.
+        """
+        async with self._lock:
+            connection = await self._open()
+            try:
+                yield connection
+            except BaseException:
+                await connection.rollback()
+                raise
 
     async def create_tables(self):
         """Создание таблиц в базе данных"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY,
@@ -117,11 +349,33 @@ class Database:
                 # Если таблица не существует, она будет создана выше
                 pass
 
+            await self._apply_migrations(db)
+
             await db.commit()
 
+    async def _apply_migrations(self, db: aiosqlite.Connection):
+        """Применяет версионные миграции MIGRATIONS, которые еще не были применены"""
+        import logging
+        logger = logging.getLogger(__name__)
+
+        async with db.execute('PRAGMA user_version') as cursor:
+            row = await cursor.fetchone()
+            current_version = row[0] if row else 0
+
+        for version, statements in MIGRATIONS:
+            if version <= current_version:
+                continue
+
+            for statement in statements:
+                await db.execute(statement)
+
+            # PRAGMA не поддерживает параметры, версия - целое число из MIGRATIONS
+            await db.execute(f'PRAGMA user_version = {int(version)}')
+            logger.info(f"Применена миграция БД версии {version}")
+
     async def add_user(self, user_id: int, username: str = None):
         """Добавление нового пользователя"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute(
                 'INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)',
                 (user_id, username)
@@ -130,7 +384,7 @@ class Database:
 
     async def set_wb_api_key(self, user_id: int, api_key: str):
         """Сохранение WB API ключа пользователя"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute(
                 'UPDATE users SET wb_api_key = ? WHERE user_id = ?',
                 (api_key, user_id)
@@ -139,7 +393,7 @@ class Database:
 
     async def get_wb_api_key(self, user_id: int) -> str | None:
         """Получение WB API ключа пользователя"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
                 'SELECT wb_api_key FROM users WHERE user_id = ?',
                 (user_id,)
@@ -157,7 +411,7 @@ class Database:
         import logging
         logger = logging.getLogger(__name__)
 
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             # Сначала проверим существует ли пользователь
             async with db.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,)) as cursor:
                 user_exists = await cursor.fetchone()
@@ -184,7 +438,7 @@ class Database:
         import logging
         logger = logging.getLogger(__name__)
 
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
                 'SELECT excel_file_path, excel_file_name FROM users WHERE user_id = ?',
                 (user_id,)
@@ -202,27 +456,54 @@ class Database:
 
     async def delete_excel_file(self, user_id: int):
         """Удаление информации о Excel файле пользователя"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute(
                 'UPDATE users SET excel_file_path = NULL, excel_file_name = NULL WHERE user_id = ?',
                 (user_id,)
             )
             await db.commit()
 
+    async def count_excel_file_references(self, file_path: str) -> int:
+        """
+        Количество пользователей, использующих Excel файл
+
+        Файлы хранятся под именем <sha256><расширение>, поэтому путь однозначно
+        определяет содержимое и служит ключом для подсчета ссылок.
+        """
+        async with self._connect() as db:
+            async with db.execute(
+                EXCEL_FILE_REFERENCES_QUERY,
+                (file_path,)
+            ) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else 0
+
     # Методы для работы с несколькими API ключами
     async def add_api_key(self, user_id: int, key_name: str, api_key: str):
         """Добавление нового API ключа (с шифрованием)"""
         encrypted_key = self.crypto.encrypt(api_key)
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute(
                 'INSERT INTO api_keys (user_id, key_name, api_key) VALUES (?, ?, ?)',
                 (user_id, key_name, encrypted_key)
             )
             await db.commit()
 
+    def _decrypt_api_key(self, key_id: int, encrypted_key: str) -> str | None:
+        """Расшифровывает API ключ, повторно используя результат из api_key_cache"""
+        cached = api_key_cache.get(key_id)
+        if cached is not None and cached[0] == encrypted_key:
+            return cached[1]
+
+        decrypted_key = self.crypto.decrypt(encrypted_key)
+        # Ошибку расшифровки не кэшируем
+        if decrypted_key is not None:
+            api_key_cache.set(key_id, (encrypted_key, decrypted_key))
+        return decrypted_key
+
     async def get_all_api_keys(self, user_id: int):
         """Получение всех API ключей пользователя (с дешифрованием)"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
                 'SELECT id, key_name, api_key, is_active FROM api_keys WHERE user_id = ? ORDER BY id',
                 (user_id,)
@@ -230,7 +511,7 @@ class Database:
                 rows = await cursor.fetchall()
                 result = []
                 for row in rows:
-                    decrypted_key = self.crypto.decrypt(row[2])
+                    decrypted_key = self._decrypt_api_key(row[0], row[2])
                     result.append({
                         'id': row[0],
                         'name': row[1],
@@ -241,15 +522,15 @@ class Database:
 
     async def get_active_api_keys(self, user_id: int):
         """Получение активных API ключей (с дешифрованием)"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
-                'SELECT id, key_name, api_key FROM api_keys WHERE user_id = ? AND is_active = 1 ORDER BY id',
+                ACTIVE_API_KEYS_QUERY,
                 (user_id,)
             ) as cursor:
                 rows = await cursor.fetchall()
                 result = []
                 for row in rows:
-                    decrypted_key = self.crypto.decrypt(row[2])
+                    decrypted_key = self._decrypt_api_key(row[0], row[2])
                     result.append({
                         'id': row[0],
                         'name': row[1],
@@ -259,22 +540,26 @@ class Database:
 
     async def toggle_api_key(self, key_id: int):
         """Включить/выключить API ключ"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute(
                 'UPDATE api_keys SET is_active = NOT is_active WHERE id = ?',
                 (key_id,)
             )
             await db.commit()
 
+        invalidate_api_key(key_id)
+
     async def delete_api_key(self, key_id: int):
         """Удаление API ключа"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute('DELETE FROM api_keys WHERE id = ?', (key_id,))
             await db.commit()
 
+        invalidate_api_key(key_id)
+
     async def update_api_key(self, key_id: int, key_name: str = None, api_key: str = None):
         """Обновление API ключа"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             if key_name and api_key:
                 encrypted_key = self.crypto.encrypt(api_key)
                 await db.execute(
@@ -294,16 +579,18 @@ class Database:
                 )
             await db.commit()
 
+        invalidate_api_key(key_id)
+
     async def get_api_key_by_id(self, key_id: int):
         """Получение API ключа по ID"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
                 'SELECT id, key_name, api_key, is_active, user_id FROM api_keys WHERE id = ?',
                 (key_id,)
             ) as cursor:
                 row = await cursor.fetchone()
                 if row:
-                    decrypted_key = self.crypto.decrypt(row[2])
+                    decrypted_key = self._decrypt_api_key(row[0], row[2])
                     return {
                         'id': row[0],
                         'name': row[1],
@@ -315,7 +602,7 @@ class Database:
 
     async def set_discount_threshold(self, user_id: int, threshold: int):
         """Установка порога скидки для пользователя"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute(
                 'UPDATE users SET discount_threshold = ? WHERE user_id = ?',
                 (threshold, user_id)
@@ -324,7 +611,7 @@ class Database:
 
     async def get_discount_threshold(self, user_id: int) -> int:
         """Получение порога скидки пользователя (по умолчанию 28%)"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
                 'SELECT discount_threshold FROM users WHERE user_id = ?',
                 (user_id,)
@@ -332,11 +619,11 @@ class Database:
                 row = await cursor.fetchone()
                 if row and row[0] is not None:
                     return row[0]
-                return 28  # значение по умолчанию
+                return DEFAULT_DISCOUNT_THRESHOLD
 
     async def get_use_default_keys(self, user_id: int) -> bool:
         """Проверка, использует ли пользователь дефолтные ключи (по умолчанию True)"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
                 'SELECT use_default_keys FROM users WHERE user_id = ?',
                 (user_id,)
@@ -344,12 +631,12 @@ class Database:
                 row = await cursor.fetchone()
                 if row and row[0] is not None:
                     return bool(row[0])
-                return True  # по умолчанию включены
+                return DEFAULT_USE_DEFAULT_KEYS
 
     async def toggle_default_keys(self, user_id: int):
         """Переключение использования дефолтных ключей"""
         current = await self.get_use_default_keys(user_id)
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute(
                 'UPDATE users SET use_default_keys = ? WHERE user_id = ?',
                 (not current, user_id)
@@ -359,38 +646,77 @@ class Database:
 
     async def get_active_api_keys_with_defaults(self, user_id: int):
         """Получение активных API ключей пользователя + дефолтные ключи (если включены)"""
-        from config import DEFAULT_API_KEYS
-
         # Получаем ключи пользователя
         user_keys = await self.get_active_api_keys(user_id)
 
         # Проверяем, нужно ли добавлять дефолтные ключи
         use_defaults = await self.get_use_default_keys(user_id)
 
-        # Добавляем дефолтные ключи (они не видны пользователю)
-        all_keys = []
+        return with_default_keys(user_keys, use_defaults)
+
+    async def get_user_context(self, user_id: int) -> UserContext:
+        """
+        Загружает подписку, настройки, Excel файл и активные ключи пользователя одним запросом
+
+        Args:
+            user_id: ID пользователя
+
+        Returns:
+            UserContext (для неизвестного пользователя - значения по умолчанию)
+        """
+        from config import ADMIN_IDS
+
+        async with self._connect() as db:
+            async with db.execute(
+                USER_CONTEXT_QUERY,
+                {'user_id': user_id, 'now': datetime.now()}
+            ) as cursor:
+                rows = await cursor.fetchall()
+
+        # Поля пользователя и подписки одинаковы во всех строках, ключи - по одному на строку
+        threshold, use_defaults, excel_path, excel_name = rows[0][:4]
 
-        # Сначала добавляем дефолтные ключи (если включены)
-        if use_defaults:
-            for idx, default_key in enumerate(DEFAULT_API_KEYS, 1):
-                all_keys.append({
-                    'id': f'default_{idx}',  # Специальный ID для дефолтных ключей
-                    'name': f'Системный ключ {idx}',
-                    'key': default_key,
-                    'is_default': True  # Флаг что это дефолтный ключ
-                })
+        subscription = None
+        if rows[0][4] is not None:
+            subscription = {
+                'id': rows[0][4],
+                'plan_id': rows[0][5],
+                'start_date': rows[0][6],
+                'end_date': rows[0][7]
+            }
 
-        # Затем добавляем пользовательские ключи
-        for key in user_keys:
-            key['is_default'] = False
-            all_keys.append(key)
+        user_keys = [{
+            'id': row[8],
+            'name': row[9],
+            'key': self._decrypt_api_key(row[8], row[10])
+        } for row in rows if row[8] is not None]
 
-        return all_keys
+        use_defaults = DEFAULT_USE_DEFAULT_KEYS if use_defaults is None else bool(use_defaults)
+
+        # Администраторы имеют бессрочную подписку (как в get_active_subscription)
+        if user_id in ADMIN_IDS:
+            subscription = await self.get_active_subscription(user_id)
+        else:
+            # Следующие проверки подписки (пагинация и т.п.) обойдутся без запроса к БД
+            cache_subscription(user_id, subscription)
+
+        end_date = subscription['end_date'] if subscription else None
+
+        return UserContext(
+            user_id=user_id,
+            has_subscription=end_date is not None,
+            subscription_end_date=end_date,
+            discount_threshold=DEFAULT_DISCOUNT_THRESHOLD if threshold is None else threshold,
+            use_default_keys=use_defaults,
+            excel_file_path=excel_path or None,
+            excel_file_name=excel_name if excel_path else None,
+            api_keys=with_default_keys(user_keys, use_defaults)
+        )
 
     # Методы для работы с подписками
     async def create_subscription(self, user_id: int, plan_id: str, yandex_order_id: str, amount: str):
         """Создание новой подписки"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute(
                 '''INSERT INTO subscriptions
                    (user_id, plan_id, yandex_order_id, amount, status)
@@ -404,7 +730,7 @@ class Database:
         from datetime import datetime, timedelta
         from config import SUBSCRIPTION_PLANS
 
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             # Получаем информацию о новой подписке
             async with db.execute(
                 'SELECT user_id, plan_id FROM subscriptions WHERE yandex_order_id = ?',
@@ -456,6 +782,7 @@ class Database:
                     (start_date, end_date, datetime.now(), yandex_order_id)
                 )
                 await db.commit()
+                invalidate_subscription(user_id)
                 return True
 
     async def get_active_subscription(self, user_id: int):
@@ -472,23 +799,28 @@ class Database:
                 'end_date': (datetime.now() + timedelta(days=36500)).isoformat()  # 100 лет
             }
 
-        async with aiosqlite.connect(self.db_name) as db:
+        cached = subscription_cache.get(user_id, _MISSING)
+        if cached is not _MISSING:
+            return cached
+
+        async with self._connect() as db:
             async with db.execute(
-                '''SELECT id, plan_id, start_date, end_date
-                   FROM subscriptions
-                   WHERE user_id = ? AND status = 'active' AND end_date > ?
-                   ORDER BY end_date DESC LIMIT 1''',
+                ACTIVE_SUBSCRIPTION_QUERY,
                 (user_id, datetime.now())
             ) as cursor:
                 row = await cursor.fetchone()
-                if row:
-                    return {
-                        'id': row[0],
-                        'plan_id': row[1],
-                        'start_date': row[2],
-                        'end_date': row[3]
-                    }
-                return None
+
+        subscription = None
+        if row:
+            subscription = {
+                'id': row[0],
+                'plan_id': row[1],
+                'start_date': row[2],
+                'end_date': row[3]
+            }
+
+        cache_subscription(user_id, subscription)
+        return subscription
 
     async def has_active_subscription(self, user_id: int) -> bool:
         """Проверка наличия активной подписки"""
@@ -499,7 +831,13 @@ class Database:
         """Отмена подписки"""
         from datetime import datetime
 
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
+            async with db.execute(
+                'SELECT user_id FROM subscriptions WHERE yandex_order_id = ?',
+                (yandex_order_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+
             await db.execute(
                 '''UPDATE subscriptions
                    SET status = 'cancelled', updated_at = ?
@@ -508,9 +846,12 @@ class Database:
             )
             await db.commit()
 
+        if row:
+            invalidate_subscription(row[0])
+
     async def get_subscription_by_order_id(self, yandex_order_id: str):
         """Получение подписки по ID заказа Яндекс Пэй"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
                 '''SELECT id, user_id, plan_id, status, amount, start_date, end_date
                    FROM subscriptions WHERE yandex_order_id = ?''',
@@ -535,7 +876,7 @@ class Database:
         import time
 
         # Проверяем, есть ли уже подписка (активная или истекшая)
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
                 'SELECT COUNT(*) FROM subscriptions WHERE user_id = ?',
                 (user_id,)
@@ -557,7 +898,9 @@ class Database:
                 (user_id, order_id, start_date, end_date)
             )
             await db.commit()
-            return True
+
+        invalidate_subscription(user_id)
+        return True
 
     # Методы для работы с платежами ЮKassa
     async def create_payment(self, user_id: int, payment_id: str, plan_id: str,
@@ -565,7 +908,7 @@ class Database:
         """Создание записи о платеже"""
         from datetime import datetime
 
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute(
                 '''INSERT INTO payments
                    (user_id, payment_id, plan_id, amount, description, confirmation_url, test, created_at)
@@ -578,7 +921,7 @@ class Database:
         """Обновление статуса платежа"""
         from datetime import datetime
 
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute(
                 '''UPDATE payments
                    SET status = ?, paid = ?, updated_at = ?
@@ -589,7 +932,7 @@ class Database:
 
     async def get_payment_by_id(self, payment_id: str):
         """Получение платежа по ID"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
                 '''SELECT id, user_id, payment_id, plan_id, amount, status, paid, test, description, confirmation_url, created_at
                    FROM payments WHERE payment_id = ?''',
@@ -614,13 +957,9 @@ class Database:
 
     async def get_user_payments(self, user_id: int, limit: int = 10):
         """Получение последних платежей пользователя"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
-                '''SELECT payment_id, plan_id, amount, status, paid, created_at
-                   FROM payments
-                   WHERE user_id = ?
-                   ORDER BY created_at DESC
-                   LIMIT ?''',
+                USER_PAYMENTS_QUERY,
                 (user_id, limit)
             ) as cursor:
                 rows = await cursor.fetchall()
@@ -639,7 +978,7 @@ class Database:
 
         cutoff_time = datetime.now() - timedelta(hours=hours)
 
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
                 '''SELECT COUNT(*) FROM payments
                    WHERE user_id = ?
@@ -656,7 +995,7 @@ class Database:
         """Сохранение платежного метода"""
         from datetime import datetime
 
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             if card_data:
                 await db.execute(
                     '''INSERT OR REPLACE INTO payment_methods
@@ -678,13 +1017,9 @@ class Database:
 
     async def get_user_payment_methods(self, user_id: int):
         """Получение всех активных платежных методов пользователя"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
-                '''SELECT id, payment_method_id, payment_method_type, card_last4, card_first6,
-                          card_type, card_expiry_month, card_expiry_year, created_at
-                   FROM payment_methods
-                   WHERE user_id = ? AND is_active = 1
-                   ORDER BY created_at DESC''',
+                USER_PAYMENT_METHODS_QUERY,
                 (user_id,)
             ) as cursor:
                 rows = await cursor.fetchall()
@@ -702,7 +1037,7 @@ class Database:
 
     async def delete_payment_method(self, payment_method_id: str):
         """Удаление (деактивация) платежного метода"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute(
                 'UPDATE payment_methods SET is_active = 0 WHERE payment_method_id = ?',
                 (payment_method_id,)
@@ -711,7 +1046,7 @@ class Database:
 
     async def get_payment_method_by_id(self, payment_method_id: str):
         """Получение платежного метода по ID"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
                 '''SELECT id, user_id, payment_method_id, payment_method_type, card_last4, card_first6,
                           card_type, card_expiry_month, card_expiry_year, is_active
@@ -744,18 +1079,18 @@ class Database:
         from datetime import datetime, timedelta
         from config import SUBSCRIPTION_PLANS
 
-        async with aiosqlite.connect(self.db_name) as db:
-            # Получаем информацию о платеже
-            payment = await self.get_payment_by_id(payment_id)
-            if not payment:
-                return False
+        # Получаем информацию о платеже
+        payment = await self.get_payment_by_id(payment_id)
+        if not payment:
+            return False
 
-            user_id = payment['user_id']
-            plan_id = payment['plan_id']
-            plan = SUBSCRIPTION_PLANS.get(plan_id)
-            if not plan:
-                return False
+        user_id = payment['user_id']
+        plan_id = payment['plan_id']
+        plan = SUBSCRIPTION_PLANS.get(plan_id)
+        if not plan:
+            return False
 
+        async with self._connect() as db:
             # Проверяем, есть ли активная подписка
             async with db.execute(
                 '''SELECT end_date FROM subscriptions
@@ -791,11 +1126,13 @@ class Database:
                 (user_id, plan_id, payment_id, payment['amount'], start_date, end_date, datetime.now())
             )
             await db.commit()
-            return True
+
+        invalidate_subscription(user_id)
+        return True
 
     async def set_user_email(self, user_id: int, email: str):
         """Сохранение email пользователя"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             await db.execute(
                 'UPDATE users SET email = ? WHERE user_id = ?',
                 (email, user_id)
@@ -804,7 +1141,7 @@ class Database:
 
     async def get_user_email(self, user_id: int) -> str | None:
         """Получение email пользователя"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             async with db.execute(
                 'SELECT email FROM users WHERE user_id = ?',
                 (user_id,)
@@ -825,21 +1162,10 @@ class Database:
         now = datetime.now()
         future_date = now + timedelta(days=days_before)
 
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connect() as db:
             # Используем GROUP BY, чтобы получить только одну (самую новую) подписку для каждого пользователя
             async with db.execute(
-                '''SELECT user_id, plan_id, end_date
-                   FROM subscriptions
-                   WHERE status = 'active'
-                     AND end_date > ?
-                     AND end_date <= ?
-                     AND id IN (
-                         SELECT MAX(id)
-                         FROM subscriptions
-                         WHERE status = 'active'
-                         GROUP BY user_id
-                     )
-                   ORDER BY end_date ASC''',
+                EXPIRING_SUBSCRIPTIONS_QUERY,
                 (now, future_date)
             ) as cursor:
                 rows = await cursor.fetchall()
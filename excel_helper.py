@@ -1,20 +1,142 @@
 """Модуль для работы с Excel файлами"""
+import asyncio
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+import time
+from collections import OrderedDict
 from openpyxl import load_workbook
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
+from cache_helper import RequestCoalescer
+from config import EXCEL_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+# Максимальная разница длин нормализованных названий при частичном совпадении
+MAX_LENGTH_DIFF = 3
+
+# Как часто (в секундах) проверять, не изменился ли файл на диске
+FILE_CHECK_INTERVAL = 1.0
+
+# Снимок разобранных данных хранится рядом с файлом: <файл>.snapshot
+SNAPSHOT_SUFFIX = '.snapshot'
+SNAPSHOT_VERSION = 1
 
 
 class ExcelHelper:
     """Класс для работы с Excel файлами с данными о категориях и комиссиях"""
 
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, watch_file: bool = True):
         """
         Инициализация
 
         Args:
             file_path: путь к Excel файлу
+            watch_file: сбрасывать данные при изменении файла на диске
         """
         self.file_path = file_path
+        self.watch_file = watch_file
         self.data_cache = None
+        # Индекс для поиска предметов (строится один раз после загрузки данных)
+        self._subject_index = None
+        # Запомненные результаты поиска: entity -> данные предмета или None
+        self._match_cache = {}
+        self.match_hits = 0
+        self.match_misses = 0
+        # (mtime, size) файла на момент загрузки данных
+        self._file_signature = None
+        self._file_checked_at = 0.0
+
+    def _get_file_signature(self) -> Optional[Tuple[float, int]]:
+        """Возвращает (mtime, size) файла или None, если файла нет"""
+        try:
+            stat = os.stat(self.file_path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def _check_file_changed(self):
+        """
+        Сбрасывает загруженные данные, индекс и запомненные результаты,
+        если файл изменился после загрузки (проверка не чаще FILE_CHECK_INTERVAL)
+        """
+        if self.data_cache is None or not self.watch_file:
+            return
+
+        now = time.monotonic()
+        if now - self._file_checked_at < FILE_CHECK_INTERVAL:
+            return
+        self._file_checked_at = now
+
+        if self._get_file_signature() != self._file_signature:
+            self.data_cache = None
+            self._subject_index = None
+            self._match_cache = {}
+
+    @property
+    def snapshot_path(self) -> str:
+        """Путь к снимку разобранных данных"""
+        return self.file_path + SNAPSHOT_SUFFIX
+
+    def _load_snapshot(self) -> Optional[Dict[str, Dict[str, str]]]:
+        """
+        Загружает данные из снимка, если он есть и соответствует текущему файлу
+
+        Returns:
+            Данные или None, если снимка нет или он устарел
+        """
+        if self._file_signature is None or not os.path.exists(self.snapshot_path):
+            return None
+
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать снимок {self.snapshot_path}: {e}")
+            return None
+
+        if (not isinstance(snapshot, dict)
+                or snapshot.get('version') != SNAPSHOT_VERSION
+                or snapshot.get('signature') != self._file_signature):
+            return None
+
+        return snapshot['data']
+
+    def write_snapshot(self) -> bool:
+        """
+        Разбирает файл (если еще не разобран) и сохраняет снимок данных рядом с ним
+
+        Returns:
+            True, если снимок записан
+        """
+        data = self.load_data()
+        if not data or self._file_signature is None:
+            return False
+
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'signature': self._file_signature,
+            'data': data
+        }
+
+        # Пишем в свой временный файл и подменяем, чтобы не оставить недописанный снимок.
+        # Имя временного файла уникально: один и тот же файл могут разбирать несколько процессов
+        snapshot_dir, snapshot_name = os.path.split(self.snapshot_path)
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=snapshot_name + '.', suffix='.tmp', dir=snapshot_dir or '.')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.snapshot_path)
+            return True
+        except OSError as e:
+            logger.warning(f"Не удалось записать снимок {self.snapshot_path}: {e}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
 
     def load_data(self) -> Dict[str, Dict[str, str]]:
         """
@@ -27,43 +149,41 @@ class ExcelHelper:
         - Столбец D: Комиссия FBS (везу на склад WB)
         - Столбец E: Комиссия самостоятельной доставки
 
+        Если рядом лежит актуальный снимок (write_snapshot), данные берутся из него
+        без разбора Excel.
+
         Returns:
             Словарь вида {предмет: {category, commission_wb, commission_fbs, commission_self}}
         """
         if self.data_cache is not None:
             return self.data_cache
 
+        self._file_signature = self._get_file_signature()
+        self._file_checked_at = time.monotonic()
+
+        data = self._load_snapshot()
+        if data is not None:
+            self.data_cache = data
+            return data
+
+        workbook = None
         try:
-            # Открываем файл без read_only для правильного определения размера
-            workbook = load_workbook(self.file_path, data_only=True)
+            # Читаем потоково: read_only не строит в памяти объекты всех ячеек
+            workbook = load_workbook(self.file_path, read_only=True, data_only=True)
             sheet = workbook.active
 
             data = {}
 
-            # Определяем реальный диапазон данных
-            # Используем dimensions для получения реального диапазона
-            max_row = sheet.max_row
-
-            # Если max_row = 1, пытаемся найти реальный размер
-            if max_row == 1:
-                # Перебираем строки до первой пустой
-                for row_num in range(1, 10000):  # Лимит 10000 строк
-                    cell_value = sheet.cell(row=row_num, column=1).value
-                    if cell_value is None and row_num > 2:
-                        max_row = row_num - 1
-                        break
-                    if row_num == 9999:
-                        max_row = 9999
-                        break
-
-            # Начинаем со второй строки (пропускаем заголовок)
-            for row_idx in range(2, max_row + 1):
-                # Читаем ячейки напрямую
-                category = sheet.cell(row=row_idx, column=1).value  # Столбец A
-                subject = sheet.cell(row=row_idx, column=2).value   # Столбец B
-                commission_wb = sheet.cell(row=row_idx, column=3).value   # Столбец C
-                commission_fbs = sheet.cell(row=row_idx, column=4).value  # Столбец D (FBS)
-                commission_self = sheet.cell(row=row_idx, column=5).value # Столбец E
+            # В read_only режиме размер листа берется из тега <dimension>, который
+            # некоторые генераторы пишут неверно (например, "A1" -> max_row = 1).
+            # Сбрасываем его, чтобы строки читались до фактического конца данных
+            sheet.reset_dimensions()
+
+            # Начинаем со второй строки (пропускаем заголовок), читаем столбцы A-E
+            for row in sheet.iter_rows(min_row=2, max_col=5, values_only=True):
+                # Короткие строки дополняем пустыми значениями
+                row = tuple(row) + (None,) * (5 - len(row))
+                category, subject, commission_wb, commission_fbs, commission_self = row[:5]
 
                 # Пропускаем пустые строки
                 if not subject:
@@ -81,7 +201,6 @@ class ExcelHelper:
                     'commission_self': str(commission_self).strip() if commission_self else ''
                 }
 
-            workbook.close()
             self.data_cache = data
             return data
 
@@ -91,6 +210,11 @@ class ExcelHelper:
             traceback.print_exc()
             return {}
 
+        finally:
+            # В read_only режиме файл открыт до close(), в том числе если разбор упал на середине
+            if workbook is not None:
+                workbook.close()
+
     def _normalize_text(self, text: str) -> str:
         """
         Нормализует текст для сравнения:
@@ -126,9 +250,25 @@ class ExcelHelper:
         Args:
             entity: название предмета из WB API
 
+        Результат (в том числе отсутствие совпадения) запоминается для каждого
+        entity, пока файл не изменится.
+
         Returns:
             Словарь с данными {category, subject, commission} или None
         """
+        self._check_file_changed()
+
+        if entity in self._match_cache:
+            self.match_hits += 1
+            return self._match_cache[entity]
+
+        self.match_misses += 1
+        result = self._find_by_subject_uncached(entity)
+        self._match_cache[entity] = result
+        return result
+
+    def _find_by_subject_uncached(self, entity: str) -> Optional[Dict[str, str]]:
+        """Поиск предмета без запомненных результатов"""
         data = self.load_data()
 
         if not data:
@@ -141,23 +281,92 @@ class ExcelHelper:
         if entity_key in data:
             return data.get(entity_key)
 
-        # Если не нашли, пробуем нормализованное совпадение
+        # Если не нашли, ищем нормализованное или частичное совпадение по индексу
         entity_normalized = self._normalize_text(entity)
+        values, normalized_index, substring_index = self._get_subject_index(data)
+
+        # Среди подходящих предметов выбираем первый по порядку в файле
+        # (так же, как при последовательном переборе строк)
+        best_idx = substring_index.get(entity_normalized)
+
+        # Предмет содержится в entity и короче его не более чем на MAX_LENGTH_DIFF символов
+        length = len(entity_normalized)
+        for sub_length in range(max(0, length - MAX_LENGTH_DIFF), length + 1):
+            for start in range(length - sub_length + 1):
+                idx = normalized_index.get(entity_normalized[start:start + sub_length])
+                if idx is not None and (best_idx is None or idx < best_idx):
+                    best_idx = idx
+
+        return values[best_idx] if best_idx is not None else None
+
+    def _get_subject_index(self, data: Dict[str, Dict[str, str]]) -> Tuple[list, Dict[str, int], Dict[str, int]]:
+        """
+        Возвращает индекс для поиска предметов, при необходимости строит его
+
+        Предмет подходит к entity, если нормализованные названия совпадают или одно
+        содержит другое при разнице длин не более MAX_LENGTH_DIFF. Индекс хранит:
+        - values: данные предметов в порядке файла
+        - normalized_index: нормализованный предмет -> номер первой строки
+        - substring_index: подстрока нормализованного предмета длиной не короче
+          предмета минус MAX_LENGTH_DIFF -> номер первой строки
 
-        for key, value in data.items():
+        Returns:
+            (values, normalized_index, substring_index)
+        """
+        if self._subject_index is not None and self._subject_index[0] is data:
+            return self._subject_index[1]
+
+        values = []
+        normalized_index = {}
+        substring_index = {}
+
+        for idx, (key, value) in enumerate(data.items()):
+            values.append(value)
             key_normalized = self._normalize_text(key)
+            normalized_index.setdefault(key_normalized, idx)
 
-            # Проверяем нормализованное совпадение
-            if entity_normalized == key_normalized:
-                return value
+            # entity содержится в предмете и короче его не более чем на MAX_LENGTH_DIFF символов
+            length = len(key_normalized)
+            for sub_length in range(max(0, length - MAX_LENGTH_DIFF), length + 1):
+                for start in range(length - sub_length + 1):
+                    substring_index.setdefault(key_normalized[start:start + sub_length], idx)
 
-            # Проверяем частичное совпадение (один содержит другой)
-            if entity_normalized in key_normalized or key_normalized in entity_normalized:
-                # Если длины похожи (разница не более 3 символов), считаем совпадением
-                if abs(len(entity_normalized) - len(key_normalized)) <= 3:
-                    return value
+        self._subject_index = (data, (values, normalized_index, substring_index))
+        return self._subject_index[1]
 
-        return None
+    def get_match_stats(self) -> Dict[str, float]:
+        """
+        Возвращает статистику запомненных результатов поиска
+
+        Returns:
+            Словарь со статистикой
+        """
+        total = self.match_hits + self.match_misses
+
+        return {
+            'entities': len(self._match_cache),
+            'hits': self.match_hits,
+            'misses': self.match_misses,
+            'hit_rate': round(self.match_hits / total, 3) if total else 0.0
+        }
+
+    def warm_up(self):
+        """Загружает данные и строит индекс поиска заранее"""
+        data = self.load_data()
+        if data:
+            self._get_subject_index(data)
+
+    def estimate_memory(self) -> int:
+        """
+        Примерный объем памяти (в байтах), занимаемый данными и индексом
+
+        Returns:
+            Размер в байтах
+        """
+        size = _deep_sizeof(self.data_cache)
+        if self._subject_index is not None:
+            size += _deep_sizeof(self._subject_index[1])
+        return size
 
     def get_stats(self) -> Dict[str, int]:
         """
@@ -177,3 +386,166 @@ class ExcelHelper:
             'total_subjects': len(data),
             'total_categories': len(categories)
         }
+
+
+def build_snapshot(file_path: str) -> Dict[str, int]:
+    """
+    Разбирает Excel файл и сохраняет снимок данных
+
+    Выполняется в отдельном процессе (ProcessPoolExecutor), поэтому
+    принимает и возвращает только простые значения.
+
+    Args:
+        file_path: путь к Excel файлу
+
+    Returns:
+        Статистика файла (get_stats) и флаг 'snapshot' - записан ли снимок
+    """
+    helper = ExcelHelper(file_path)
+    stats = helper.get_stats()
+    stats['snapshot'] = helper.write_snapshot()
+    return stats
+
+
+def remove_snapshot(file_path: str):
+    """Удаляет снимок данных файла (при удалении самого файла)"""
+    snapshot_path = file_path + SNAPSHOT_SUFFIX
+    if os.path.exists(snapshot_path):
+        os.remove(snapshot_path)
+
+
+def _deep_sizeof(obj, seen: Optional[set] = None) -> int:
+    """Примерный размер объекта в памяти вместе с вложенными dict/list/tuple/строками"""
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_sizeof(item, seen) for item in obj)
+
+    return size
+
+
+# Реестр загруженных файлов: хэш содержимого -> (ExcelHelper, размер в байтах).
+# Один и тот же файл (в том числе загруженный разными пользователями) разбирается один раз
+_helpers_registry = OrderedDict()
+_helpers_registry_bytes = 0
+
+# (путь, mtime, size) -> хэш содержимого, чтобы не перечитывать неизмененный файл
+_file_digests = {}
+
+# Одновременные загрузки одного файла в реестр объединяются
+_helper_loads = RequestCoalescer()
+
+
+def compute_file_digest(file_path: str) -> str:
+    """Возвращает sha256 содержимого файла"""
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _get_file_signature(file_path: str) -> Tuple[str, float, int]:
+    """(путь, mtime, size) файла - ключ запомненного хэша"""
+    stat = os.stat(file_path)
+    return os.path.abspath(file_path), stat.st_mtime, stat.st_size
+
+
+def _remember_file_digest(signature: Tuple[str, float, int], digest: str):
+    """Запоминает хэш файла, убирая устаревшие версии этого же пути"""
+    for old_signature in [s for s in _file_digests if s[0] == signature[0]]:
+        del _file_digests[old_signature]
+    _file_digests[signature] = digest
+
+
+def _get_registered_helper(digest: str) -> Optional['ExcelHelper']:
+    """ExcelHelper из реестра (None, если файла там нет)"""
+    entry = _helpers_registry.get(digest)
+    if entry is None:
+        return None
+
+    _helpers_registry.move_to_end(digest)
+    return entry[0]
+
+
+def _build_helper(file_path: str) -> Tuple['ExcelHelper', int]:
+    """Загружает файл (снимок или разбор openpyxl) и строит индекс; долгая операция"""
+    # Содержимое определяется хэшем, следить за изменением файла не нужно
+    helper = ExcelHelper(file_path, watch_file=False)
+    helper.warm_up()
+    return helper, helper.estimate_memory() if helper.data_cache else 0
+
+
+def _register_helper(file_path: str, digest: str, helper: 'ExcelHelper', size: int):
+    """Добавляет загруженный файл в реестр и вытесняет давно не использованные"""
+    global _helpers_registry_bytes
+
+    # Файл не удалось прочитать - не запоминаем, чтобы попробовать снова
+    if not helper.data_cache:
+        return
+
+    _helpers_registry[digest] = (helper, size)
+    _helpers_registry_bytes += size
+
+    # Вытесняем давно не использованные файлы (последний добавленный остается всегда)
+    while _helpers_registry_bytes > EXCEL_CACHE_MAX_BYTES and len(_helpers_registry) > 1:
+        old_digest, (_, old_size) = _helpers_registry.popitem(last=False)
+        _helpers_registry_bytes -= old_size
+        for signature in [s for s, d in _file_digests.items() if d == old_digest]:
+            del _file_digests[signature]
+
+    logger.info(
+        f"Excel {file_path} загружен в реестр: ~{size // 1024} KB, "
+        f"файлов {len(_helpers_registry)}, всего ~{_helpers_registry_bytes // 1024} KB"
+    )
+
+
+async def load_excel_helper(file_path: str) -> ExcelHelper:
+    """
+    Возвращает ExcelHelper с уже загруженными данными из общего реестра
+
+    Файлы различаются по хэшу содержимого, поэтому одинаковые файлы разных
+    пользователей разбираются один раз. Реестр ограничен EXCEL_CACHE_MAX_BYTES:
+    при превышении вытесняются давно не использованные файлы.
+
+    Хэш и разбор файла выполняются в потоке, чтобы не блокировать event loop;
+    реестр и запомненные хэши меняются только в event loop, одновременные
+    загрузки одного файла объединяются.
+
+    Args:
+        file_path: путь к Excel файлу
+
+    Returns:
+        ExcelHelper с загруженными данными и индексом поиска
+    """
+    loop = asyncio.get_running_loop()
+
+    signature = _get_file_signature(file_path)
+    digest = _file_digests.get(signature)
+    if digest is None:
+        digest = await loop.run_in_executor(None, compute_file_digest, file_path)
+        _remember_file_digest(signature, digest)
+
+    helper = _get_registered_helper(digest)
+    if helper is not None:
+        return helper
+
+    async def load() -> ExcelHelper:
+        # Пока ждали, файл мог загрузить другой вызов
+        registered = _get_registered_helper(digest)
+        if registered is not None:
+            return registered
+
+        built, size = await loop.run_in_executor(None, _build_helper, file_path)
+        _register_helper(file_path, digest, built, size)
+        return built
+
+    return await _helper_loads.run(digest, load)
@@ -103,7 +103,8 @@ def get_confirm_delete_keyboard(key_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def get_pagination_keyboard(current_page: int, total_pages: int, key_name: str = None) -> InlineKeyboardMarkup:
+def get_pagination_keyboard(current_page: int, total_pages: int, key_name: str = None,
+                            current_sub_page: int = 0, total_sub_pages: int = 1) -> InlineKeyboardMarkup:
     """
     Клавиатура пагинации для результатов
 
@@ -111,20 +112,42 @@ def get_pagination_keyboard(current_page: int, total_pages: int, key_name: str =
         current_page: текущая страница (от 0)
         total_pages: общее количество страниц
         key_name: название ключа для отображения
+        current_sub_page: текущая часть страницы (от 0)
+        total_sub_pages: количество частей текущей страницы
     """
     keyboard = []
 
+    # Кнопки переключения частей страницы (если товары ключа не поместились в одно сообщение)
+    if total_sub_pages > 1:
+        sub_buttons = []
+
+        if current_sub_page > 0:
+            sub_buttons.append(InlineKeyboardButton(
+                text="◀️", callback_data=f"page:{current_page}:{current_sub_page - 1}"
+            ))
+
+        sub_buttons.append(InlineKeyboardButton(
+            text=f"Часть {current_sub_page + 1}/{total_sub_pages}", callback_data="noop"
+        ))
+
+        if current_sub_page < total_sub_pages - 1:
+            sub_buttons.append(InlineKeyboardButton(
+                text="▶️", callback_data=f"page:{current_page}:{current_sub_page + 1}"
+            ))
+
+        keyboard.append(sub_buttons)
+
     # Кнопки навигации
     nav_buttons = []
 
     if current_page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"page:{current_page - 1}"))
+        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"page:{current_page - 1}:0"))
 
     # Показываем номер страницы
     nav_buttons.append(InlineKeyboardButton(text=f"{current_page + 1}/{total_pages}", callback_data="noop"))
 
     if current_page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"page:{current_page + 1}"))
+        nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"page:{current_page + 1}:0"))
 
     if nav_buttons:
         keyboard.append(nav_buttons)
@@ -3,16 +3,23 @@ import asyncio
 import logging
 import os
 import html
+import multiprocessing
+import weakref
+from concurrent.futures import ProcessPoolExecutor
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, CallbackQuery
 
-from config import BOT_TOKEN
+from config import (
+    BOT_TOKEN, KEYS_MAX_CONCURRENCY, KEYS_MAX_CONCURRENCY_PER_USER, EXCEL_PARSE_WORKERS,
+    RESULT_STORE_BACKEND, RESULT_STORE_PATH, RESULT_STORE_TTL, RESULT_STORE_MAX_BYTES, RESULT_PAGE_MAX_LENGTH
+)
 from database import Database
-from wb_api import WildberriesAPI
-from excel_helper import ExcelHelper
+from wb_api import WildberriesAPI, init_http_session, close_http_session, merge_cards_results
+from excel_helper import build_snapshot, compute_file_digest, load_excel_helper, remove_snapshot
+from result_store import compact_key_result, create_result_store
 from keyboards import (
     get_main_menu,
     get_settings_menu,
@@ -46,8 +53,25 @@ router = Router()
 # Инициализация базы данных
 db = Database()
 
-# Хранилище для результатов пагинации (user_id -> {pages, current_page, key_results})
-pagination_storage = {}
+# Хранилище результатов поиска для пагинации (страница = ключ)
+result_store = create_result_store(
+    RESULT_STORE_BACKEND, RESULT_STORE_PATH, max_bytes=RESULT_STORE_MAX_BYTES, ttl=RESULT_STORE_TTL
+)
+
+# Ограничения параллельной обработки ключей: общее и на пользователя
+# (семафор пользователя живет, пока идет хотя бы один его поиск)
+keys_semaphore = asyncio.Semaphore(KEYS_MAX_CONCURRENCY)
+user_keys_semaphores = weakref.WeakValueDictionary()
+
+# Общие Excel файлы (user_files/<sha256>): размещение файла с записью ссылки в БД
+# и проверка ссылок с удалением файла выполняются под этой блокировкой
+excel_files_lock = asyncio.Lock()
+
+# Процессы для разбора загруженных Excel файлов (создаются в main())
+excel_executor = None
+
+# Фоновые задачи (храним ссылки, чтобы задачи не были удалены сборщиком мусора)
+background_tasks = set()
 
 
 # Состояния для FSM
@@ -216,8 +240,11 @@ async def get_products(message: Message):
     """Получение списка товаров по всем активным ключам (включая дефолтные)"""
     user_id = message.from_user.id
 
+    # Подписка, настройки, Excel файл и ключи одним запросом
+    context = await db.get_user_context(user_id)
+
     # Проверка активной подписки
-    if not await db.has_active_subscription(user_id):
+    if not context.has_subscription:
         await message.answer(
             "⚠️ Для доступа к этой функции необходима активная подписка.\n\n"
             "Нажмите '💳 Подписка' для оформления.",
@@ -225,8 +252,8 @@ async def get_products(message: Message):
         )
         return
 
-    # Получаем все активные ключи (пользовательские + дефолтные)
-    active_keys = await db.get_active_api_keys_with_defaults(user_id)
+    # Все активные ключи (пользовательские + дефолтные)
+    active_keys = context.api_keys
 
     if not active_keys:
         await message.answer(
@@ -243,48 +270,51 @@ async def get_products(message: Message):
     # Сообщение показывает общее количество ключей (пользовательские + дефолтные)
     await message.answer(f"⏳ Обрабатываю {total_keys} активных ключей...")
 
-    # Получаем порог скидки пользователя
-    user_threshold = await db.get_discount_threshold(user_id)
+    # Порог скидки пользователя
+    user_threshold = context.discount_threshold
     logger.info(f"Порог скидки пользователя {user_id}: {user_threshold}%")
 
     # Загружаем Excel файл пользователя (если есть)
     excel_helper = None
-    excel_file_data = await db.get_excel_file(user_id)
+    excel_file_data = context.excel_file
     if excel_file_data:
         excel_path, excel_name = excel_file_data
         if os.path.exists(excel_path):
             try:
-                excel_helper = ExcelHelper(excel_path)
+                excel_helper = await load_excel_helper(excel_path)
                 stats = excel_helper.get_stats()
                 logger.info(f"Excel загружен: {stats}")
             except Exception as e:
                 logger.error(f"Ошибка загрузки Excel: {e}")
 
-    # Обрабатываем каждый ключ
-    all_key_results = []
-    user_key_idx = 0  # Счетчик для пользовательских ключей
+    # Обрабатываем ключи параллельно, результаты сохраняем в исходном порядке
+    user_semaphore = user_keys_semaphores.get(user_id)
+    if user_semaphore is None:
+        user_semaphore = asyncio.Semaphore(KEYS_MAX_CONCURRENCY_PER_USER)
+        user_keys_semaphores[user_id] = user_semaphore
+
+    all_key_results = [None] * total_keys
+    user_keys_done = 0  # Счетчик обработанных пользовательских ключей
+
+    async def process_key(idx: int, key_data: dict):
+        nonlocal user_keys_done
 
-    for key_data in active_keys:
         key_name = key_data['name']
         api_key = key_data['key']
         is_default = key_data.get('is_default', False)
 
-        # Показываем прогресс только для пользовательских ключей
-        if not is_default:
-            user_key_idx += 1
-            await message.answer(f"🔑 Обрабатываю ключ {user_key_idx}/{user_keys_count}: '{key_name}'...")
-
-        # Вызываем функцию обработки одного ключа
-        key_result = await process_single_key(api_key, key_name, excel_helper, user_threshold)
+        async with user_semaphore, keys_semaphore:
+            # Вызываем функцию обработки одного ключа
+            key_result = await process_single_key(api_key, key_name, excel_helper, user_threshold, is_default)
 
         if key_result:
             key_result['is_default'] = is_default  # Помечаем результат
-            all_key_results.append(key_result)
+            all_key_results[idx] = key_result
             logger.info(f"Ключ '{key_name}' (default={is_default}): найдено {len(key_result['unique_goods'])} уникальных товаров")
         else:
             # Добавляем пустой результат для этого ключа
             logger.info(f"Ключ '{key_name}' (default={is_default}): товары не найдены")
-            all_key_results.append({
+            all_key_results[idx] = {
                 'key_name': key_name,
                 'stats_text': '',
                 'unique_goods': [],
@@ -294,13 +324,20 @@ async def get_products(message: Message):
                 'goods_filtered': 0,
                 'no_results': True,  # Флаг что результатов нет
                 'is_default': is_default
-            })
+            }
 
-    # Сохраняем результаты для пагинации (одна страница = один ключ)
-    pagination_storage[user_id] = {
-        'results': all_key_results,
-        'current_page': 0
-    }
+        # Показываем прогресс только для пользовательских ключей
+        if not is_default:
+            user_keys_done += 1
+            await message.answer(f"🔑 Обработан ключ {user_keys_done}/{user_keys_count}: '{key_name}'")
+
+    await asyncio.gather(*(process_key(idx, key_data) for idx, key_data in enumerate(active_keys)))
+
+    if excel_helper:
+        logger.info(f"Excel сопоставление предметов: {excel_helper.get_match_stats()}")
+
+    # Сохраняем результаты для пагинации (одна страница = один ключ, текст формируется один раз)
+    await result_store.put(user_id, build_result_pages(all_key_results))
 
     # Показываем первую страницу
     await show_page(message, user_id, 0)
@@ -314,18 +351,51 @@ def format_price(price: float) -> str:
         return f"{price:.2f}"
 
 
-async def process_single_key(api_key: str, key_name: str, excel_helper, threshold: int = 28):
+async def process_single_key(api_key: str, key_name: str, excel_helper, threshold: int = 28,
+                             is_default: bool = False):
     """Обработка одного API ключа"""
 
     wb_api = WildberriesAPI(api_key)
-    result = await wb_api.get_goods_list(limit=1000)
 
-    if not result['success']:
-        logger.error(f"Ошибка для ключа '{key_name}': {result['error']}")
-        return None
+    goods = []
+    nm_ids = []
+    cards_tasks = []
+
+    if is_default:
+        # Дефолтные ключи одинаковы для всех подписчиков - список товаров
+        # берем из общего кэша, по пользователю выполняется только фильтрация
+        result = await wb_api.get_all_goods_shared()
 
-    data = result['data']
-    goods = data.get('data', {}).get('listGoods', [])
+        if not result['success']:
+            logger.error(f"Ошибка для ключа '{key_name}': {result['error']}")
+            return None
+
+        goods = result['goods']
+        nm_ids = [product.get('nmID') for product in goods if product.get('nmID')]
+        if nm_ids:
+            cards_tasks.append(asyncio.create_task(wb_api.get_cards_detail(nm_ids)))
+    else:
+        # Загружаем все страницы listGoods; Cards API для каждой страницы
+        # запрашиваем сразу по её получении, не дожидаясь остального каталога
+        async for page in wb_api.iter_goods_pages():
+            if not page['success']:
+                if not goods:
+                    logger.error(f"Ошибка для ключа '{key_name}': {page['error']}")
+                    return None
+
+                logger.warning(
+                    f"Ключ '{key_name}': страница offset={page['offset']} не получена ({page['error']}), "
+                    f"продолжаем с {len(goods)} товарами"
+                )
+                break
+
+            page_goods = page['goods']
+            goods.extend(page_goods)
+
+            page_nm_ids = [product.get('nmID') for product in page_goods if product.get('nmID')]
+            if page_nm_ids:
+                nm_ids.extend(page_nm_ids)
+                cards_tasks.append(asyncio.create_task(wb_api.get_cards_detail(page_nm_ids)))
 
     if not goods:
         logger.info(f"Ключ '{key_name}': список товаров пуст")
@@ -335,17 +405,10 @@ async def process_single_key(api_key: str, key_name: str, excel_helper, threshol
     logger.info(f"Ключ '{key_name}': всего товаров {len(goods)}")
 
     # Логируем первые 3 товара для отладки
-    if goods:
-        logger.info(f"Ключ '{key_name}': примеры товаров nmID={[g.get('nmID') for g in goods[:3]]}")
+    logger.info(f"Ключ '{key_name}': примеры товаров nmID={[g.get('nmID') for g in goods[:3]]}")
 
-    if not goods:
-        logger.warning(f"Ключ '{key_name}': список товаров пуст после получения от API")
-        return None
-
-    # Получаем реальные цены с сайта WB для ВСЕХ товаров
-    nm_ids = [product.get('nmID') for product in goods if product.get('nmID')]
-
-    cards_result = await wb_api.get_cards_detail(nm_ids)
+    # Реальные цены с сайта WB для ВСЕХ товаров (запросы уже запущены постранично)
+    cards_result = merge_cards_results(await asyncio.gather(*cards_tasks))
 
     # Создаем словари для быстрого поиска цен и информации о товарах по nmId
     real_prices = {}
@@ -579,108 +642,156 @@ async def process_single_key(api_key: str, key_name: str, excel_helper, threshol
     }
 
 
-async def show_page(message_or_callback, user_id: int, page: int):
-    """Показывает страницу результатов"""
+def utf16_length(text: str) -> int:
+    """Длина текста в UTF-16 code units (так Telegram считает лимит сообщения)"""
+    return len(text.encode('utf-16-le')) // 2
 
-    if user_id not in pagination_storage:
-        if isinstance(message_or_callback, Message):
-            await message_or_callback.answer("📦 Нет сохраненных результатов. Запустите поиск заново.")
-        else:
-            await message_or_callback.message.answer("📦 Нет сохраненных результатов. Запустите поиск заново.")
-        return
 
-    storage = pagination_storage[user_id]
-    all_results = storage['results']
+def render_product(i: int, info: dict) -> str:
+    """Формирует блок одного товара на странице результатов"""
+    lines = []
 
-    if page < 0 or page >= len(all_results):
-        if isinstance(message_or_callback, Message):
-            await message_or_callback.answer("❌ Страница не найдена")
-        else:
-            await message_or_callback.message.answer("❌ Страница не найдена")
-        return
+    # Если есть данные из Excel - показываем Категория → Предмет
+    if info.get('excel_category') and info.get('excel_subject'):
+        lines.append(f"{i}. {info['excel_category']} → {info['excel_subject']}\n")
+    elif info.get('entity'):
+        lines.append(f"{i}. 📂 {info['entity']}\n")
+    else:
+        lines.append(f"{i}. Артикул: {info['nm_id']}\n")
 
-    result = all_results[page]
+    # Наименование товара
+    if info.get('name'):
+        lines.append(f"   📝 {info['name']}\n")
 
-    # Формируем сообщение для этого ключа
-    is_default = result.get('is_default', False)
+    # СПП (скидка постоянного покупателя)
+    if 'spp' in info:
+        lines.append(f"   ✅ СПП: {info['spp']:.1f}%\n")
+
+    # FBO и FBS комиссии из Excel (если есть)
+    if info.get('excel_commission_wb'):
+        lines.append(f"   💼 FBO комиссия: {info['excel_commission_wb']}\n")
+    if info.get('excel_commission_fbs'):
+        lines.append(f"   💼 FBS комиссия: {info['excel_commission_fbs']}\n")
+
+    lines.append("\n")
+    return ''.join(lines)
 
-    # Для дефолтных ключей не показываем название
-    if not is_default:
-        text = f"🔑 Ключ: {result['key_name']}\n"
-    else:
-        text = ""
 
-    text += f"Страница {page + 1}/{len(all_results)}\n\n"
+def render_page_texts(result: dict, page: int, total_pages: int,
+                      max_length: int = RESULT_PAGE_MAX_LENGTH) -> list:
+    """
+    Формирует текст страницы результатов ключа, разбивая товары на части по размеру сообщения
+
+    Args:
+        result: компактный результат ключа (см. compact_key_result)
+        page: номер страницы (от 0)
+        total_pages: всего страниц
+        max_length: максимальная длина одной части в UTF-16 code units
+
+    Returns:
+        Тексты частей страницы (хотя бы одна)
+    """
+    # Для дефолтных ключей не показываем название
+    key_line = "" if result.get('is_default', False) else f"🔑 Ключ: {result['key_name']}\n"
 
     # Проверяем есть ли результаты
     if result.get('no_results'):
-        text += "⚠️ Нет товаров, подходящих по критериям\n\n"
-        text += "Возможные причины:\n"
-        text += "  • Нет товаров в личном кабинете\n"
-        text += f"  • Все товары отфильтрованы по критерию реальной скидки ≥{result.get('threshold', 28)}%\n"
-    else:
-        # Статистика убрана для компактности
-        # text += result['stats_text']
+        return [''.join([
+            key_line,
+            f"Страница {page + 1}/{total_pages}\n\n",
+            "⚠️ Нет товаров, подходящих по критериям\n\n",
+            "Возможные причины:\n",
+            "  • Нет товаров в личном кабинете\n",
+            f"  • Все товары отфильтрованы по критерию реальной скидки ≥{result.get('threshold', 28)}%\n"
+        ])]
+
+    # Показываем ВСЕ товары (статистика убрана для компактности)
+    goods_to_display = result['items']
+    goods_line = (
+        f"📦 Товары (всего: {result['total_goods']}, подходит по критерию ≥{result.get('threshold', 28)}%: "
+        f"{result['goods_filtered']}, показано: {len(goods_to_display)})\n\n"
+    )
 
-        # Показываем ВСЕ товары (убираем ограничение [:20])
-        goods_to_display = result['unique_goods']
+    def header(sub_page: int, total_sub_pages: int) -> str:
+        part = f" (часть {sub_page + 1}/{total_sub_pages})" if total_sub_pages > 1 else ""
+        return f"{key_line}Страница {page + 1}/{total_pages}{part}\n\n{goods_line}"
 
-        text += f"📦 Товары (всего: {result['total_goods']}, подходит по критерию ≥{result.get('threshold', 28)}%: {result['goods_filtered']}, показано: {len(goods_to_display)})\n\n"
+    blocks = [render_product(i, info) for i, info in enumerate(goods_to_display, 1)]
 
-        # Отображаем товары только если они есть
-        for i, product in enumerate(goods_to_display, 1):
-            nm_id = product.get('nmID', 'N/A')
+    # Место под товары считаем по самому длинному заголовку (частей не больше, чем товаров)
+    budget = max_length - utf16_length(header(len(blocks), len(blocks)))
 
-            # Получаем скидку продавца из Discounts API
-            seller_discount = product.get('discount', 0)
+    chunks = [[]]
+    chunk_length = 0
+    for block in blocks:
+        block_length = utf16_length(block)
+        if block_length > budget:
+            # Один товар не помещается в сообщение - обрезаем (символ занимает не больше 2 code units)
+            block = block[:max(budget // 2 - 3, 0)] + "…\n\n"
+            block_length = utf16_length(block)
 
-            # Получаем информацию о товаре
-            info = result['product_info'].get(nm_id, {}) if nm_id != 'N/A' else {}
+        if chunks[-1] and chunk_length + block_length > budget:
+            chunks.append([])
+            chunk_length = 0
 
-            # Формируем заголовок товара
-            text += f"{i}. "
+        chunks[-1].append(block)
+        chunk_length += block_length
+
+    return [header(sub_page, len(chunks)) + ''.join(chunk) for sub_page, chunk in enumerate(chunks)]
 
-            # Если есть данные из Excel - показываем Категория → Предмет
-            if info.get('excel_category') and info.get('excel_subject'):
-                text += f"{info['excel_category']} → {info['excel_subject']}\n"
-            elif info.get('entity'):
-                text += f"📂 {info['entity']}\n"
-            else:
-                text += f"Артикул: {nm_id}\n"
 
-            # Наименование товара
-            if info.get('name'):
-                text += f"   📝 {info['name']}\n"
+def build_result_pages(all_key_results: list) -> list:
+    """
+    Готовит страницы для хранилища: тексты каждой страницы формируются один раз
 
-            # Рассчитываем реальную скидку и показываем только СПП
-            if nm_id != 'N/A':
-                price_data = result['real_prices'].get(nm_id)
-                if price_data:
-                    real_price = price_data['real']
-                    basic_price = price_data['basic']
+    Args:
+        all_key_results: результаты ключей в порядке страниц
 
-                    if basic_price > 0:
-                        # Рассчитываем скидку на сайте
-                        site_discount = ((basic_price - real_price) / basic_price) * 100
-                        # СПП (скидка постоянного покупателя)
-                        real_discount = site_discount - seller_discount
+    Returns:
+        Список страниц {'key_name', 'is_default', 'texts'} (texts - части страницы)
+    """
+    total_pages = len(all_key_results)
+    pages = []
 
-                        text += f"   ✅ СПП: {real_discount:.1f}%\n"
+    for page, key_result in enumerate(all_key_results):
+        result = compact_key_result(key_result)
+        pages.append({
+            'key_name': result['key_name'],
+            'is_default': result['is_default'],
+            'texts': render_page_texts(result, page, total_pages)
+        })
 
-            # Показываем FBO комиссию из Excel (если есть)
-            if info.get('excel_commission_wb'):
-                text += f"   💼 FBO комиссия: {info['excel_commission_wb']}\n"
+    return pages
 
-            # Показываем FBS комиссию из Excel (если есть)
-            if info.get('excel_commission_fbs'):
-                text += f"   💼 FBS комиссия: {info['excel_commission_fbs']}\n"
 
-            text += "\n"
+async def show_page(message_or_callback, user_id: int, page: int, sub_page: int = 0):
+    """Показывает часть sub_page страницы результатов page (тексты уже сформированы)"""
+
+    found = await result_store.get_page(user_id, page)
+
+    if found is None:
+        if isinstance(message_or_callback, Message):
+            await message_or_callback.answer("📦 Нет сохраненных результатов. Запустите поиск заново.")
+        else:
+            await message_or_callback.message.answer("📦 Нет сохраненных результатов. Запустите поиск заново.")
+        return
+
+    result, total_pages = found
+
+    if result is None or not 0 <= sub_page < len(result['texts']):
+        if isinstance(message_or_callback, Message):
+            await message_or_callback.answer("❌ Страница не найдена")
+        else:
+            await message_or_callback.message.answer("❌ Страница не найдена")
+        return
+
+    text = result['texts'][sub_page]
+    is_default = result.get('is_default', False)
 
     # Отправляем или редактируем сообщение
     # Для дефолтных ключей не передаем название
     key_name_to_show = None if is_default else result['key_name']
-    keyboard = get_pagination_keyboard(page, len(all_results), key_name_to_show)
+    keyboard = get_pagination_keyboard(page, total_pages, key_name_to_show, sub_page, len(result['texts']))
 
     # Проверяем тип объекта
     if isinstance(message_or_callback, CallbackQuery):
@@ -694,8 +805,6 @@ async def show_page(message_or_callback, user_id: int, page: int):
         # Это обычное сообщение (Message) - отправляем новое
         await message_or_callback.answer(text, reply_markup=keyboard)
 
-    pagination_storage[user_id]['current_page'] = page
-
 
 #  Обработчик пагинации
 @router.callback_query(F.data.startswith("page:"))
@@ -708,9 +817,12 @@ async def pagination_handler(callback: CallbackQuery):
         await callback.answer("⚠️ Необходима активная подписка", show_alert=True)
         return
 
-    page = int(callback.data.split(":")[1])
+    # page:{страница}:{часть}; старые кнопки page:{страница} открывают первую часть
+    parts = callback.data.split(":")
+    page = int(parts[1])
+    sub_page = int(parts[2]) if len(parts) > 2 else 0
 
-    await show_page(callback, user_id, page)
+    await show_page(callback, user_id, page, sub_page)
     await callback.answer()
 
 
@@ -876,34 +988,118 @@ async def upload_excel_process(message: Message, state: FSMContext):
         await message.answer("❌ Пожалуйста, отправьте файл Excel (.xlsx или .xls)")
         return
 
+    tmp_path = None
+
     try:
         # Создаем папку для файлов если её нет
         files_dir = "user_files"
         os.makedirs(files_dir, exist_ok=True)
         logger.info(f"Директория {files_dir} создана/проверена")
 
-        # Формируем путь к файлу
-        file_path = os.path.join(files_dir, f"{user_id}_{document.file_name}")
-        logger.info(f"Путь к файлу: {file_path}")
+        # Скачиваем файл во временный путь
+        extension = os.path.splitext(document.file_name)[1].lower()
+        tmp_path = os.path.join(files_dir, f"tmp_{user_id}_{document.file_unique_id}{extension}")
+        await bot.download(document, destination=tmp_path)
+        logger.info(f"Файл скачан: {tmp_path}")
+
+        # Файлы хранятся по хэшу содержимого: одинаковый файл разных пользователей
+        # лежит на диске один раз и разбирается один раз
+        loop = asyncio.get_running_loop()
+        file_hash = await loop.run_in_executor(None, compute_file_digest, tmp_path)
+        file_path = os.path.join(files_dir, f"{file_hash}{extension}")
+
+        # Размещение файла и запись в БД - под общей блокировкой: иначе другой пользователь
+        # может удалить общий файл между проверкой его наличия и записью ссылки на него
+        async with excel_files_lock:
+            placed_new_file = not os.path.exists(file_path)
+            if placed_new_file:
+                os.replace(tmp_path, file_path)
+                logger.info(f"Путь к файлу: {file_path}")
+            else:
+                logger.info(f"Файл с таким содержимым уже есть: {file_path}")
 
-        # Скачиваем файл
-        await bot.download(document, destination=file_path)
-        logger.info(f"Файл скачан: {file_path}")
+            try:
+                # Предыдущий файл пользователя (удалим, если на него больше никто не ссылается)
+                old_file_data = await db.get_excel_file(user_id)
 
-        # Сохраняем информацию в БД
-        await db.set_excel_file(user_id, file_path, document.file_name)
-        logger.info(f"Информация о файле сохранена в БД для пользователя {user_id}")
+                # Сохраняем информацию в БД
+                await db.set_excel_file(user_id, file_path, document.file_name)
+                logger.info(f"Информация о файле сохранена в БД для пользователя {user_id}")
+            except Exception:
+                # Только что размещенный файл (под блокировкой) никто, кроме нас, не использует
+                if placed_new_file and os.path.exists(file_path):
+                    os.remove(file_path)
+                raise
+
+        if old_file_data and old_file_data[0] != file_path:
+            await remove_unused_excel_file(old_file_data[0])
 
         await message.answer(
             f"✅ Excel файл '{document.file_name}' успешно загружен!\n\n"
-            "Файл будет использоваться для работы с товарами.",
+            "⏳ Проверяю содержимое файла...",
             reply_markup=get_main_menu(True)  # Пользователь с подпиской
         )
         await state.clear()
+
+        # Разбираем файл в фоне, чтобы не задерживать ответ и первый поиск
+        task = asyncio.create_task(parse_uploaded_excel(message, file_path, document.file_name))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
     except Exception as e:
         logger.error(f"Ошибка при загрузке файла: {e}")
         await message.answer(f"❌ Ошибка при загрузке файла: {str(e)}")
         await state.clear()
+    finally:
+        # Временный файл остается, если загрузка прервалась или файл уже был на диске
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+async def remove_unused_excel_file(file_path: str):
+    """Удаляет Excel файл и его снимок с диска, если на файл не ссылается ни один пользователь"""
+    async with excel_files_lock:
+        if await db.count_excel_file_references(file_path) > 0:
+            return
+
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        remove_snapshot(file_path)
+        logger.info(f"Файл удален с диска: {file_path}")
+
+
+async def parse_uploaded_excel(message: Message, file_path: str, file_name: str):
+    """Разбор загруженного Excel файла в отдельном процессе и отчет пользователю"""
+    loop = asyncio.get_running_loop()
+
+    try:
+        stats = await loop.run_in_executor(excel_executor, build_snapshot, file_path)
+    except Exception as e:
+        logger.error(f"Ошибка разбора Excel {file_path}: {e}")
+        await message.answer(f"❌ Не удалось прочитать файл '{file_name}': {str(e)}")
+        return
+
+    logger.info(f"Excel {file_path} разобран: {stats}")
+
+    if not stats['total_subjects']:
+        await message.answer(
+            f"⚠️ В файле '{file_name}' не найдено ни одного предмета.\n\n"
+            "Проверьте структуру: A - Категория, B - Предмет, C - Комиссия WB (FBO), "
+            "D - Комиссия FBS, E - Комиссия самостоятельной доставки. Первая строка - заголовок."
+        )
+        return
+
+    # Загружаем снимок в общий реестр, чтобы первый поиск не ждал разбора
+    try:
+        await load_excel_helper(file_path)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки Excel {file_path} в реестр: {e}")
+
+    await message.answer(
+        f"📊 Файл '{file_name}' обработан\n\n"
+        f"Предметов: {stats['total_subjects']}\n"
+        f"Категорий: {stats['total_categories']}\n\n"
+        "Файл будет использоваться для работы с товарами."
+    )
 
 
 # Обработчик показа текущего файла
@@ -956,13 +1152,13 @@ async def delete_excel_file(callback: CallbackQuery):
 
     if file_data:
         file_path, file_name = file_data
-        # Удаляем файл с диска если он существует
-        if os.path.exists(file_path):
-            os.remove(file_path)
 
         # Удаляем информацию из БД
         await db.delete_excel_file(user_id)
 
+        # Удаляем файл с диска, если его больше не использует ни один пользователь
+        await remove_unused_excel_file(file_path)
+
         await callback.message.answer(
             f"🗑️ Excel файл '{file_name}' удален",
             reply_markup=get_main_menu(True)  # Пользователь с подпиской
@@ -2167,9 +2363,23 @@ async def confirm_unbind_card(callback: CallbackQuery):
 
 async def main():
     """Главная функция запуска бота"""
-    # Создаем таблицы в БД
+    global excel_executor
+
+    # Открываем соединение с БД (одно на все запросы) и создаем таблицы
+    await db.connect()
     await db.create_tables()
 
+    # Открываем общий пул HTTP соединений к WB API
+    await init_http_session()
+
+    # Процессы для разбора Excel файлов (openpyxl нагружает CPU). Не fork: в процессе уже
+    # работают потоки aiosqlite и пула, а fork при захваченной ими блокировке (logging, stdio)
+    # может повесить дочерний процесс. build_snapshot принимает и возвращает простые значения
+    excel_executor = ProcessPoolExecutor(
+        max_workers=EXCEL_PARSE_WORKERS,
+        mp_context=multiprocessing.get_context('forkserver')
+    )
+
     # Регистрируем роутер
     dp.include_router(router)
 
@@ -2182,7 +2392,15 @@ async def main():
 
     # Запускаем бота
     logger.info("Бот запущен")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # Закрываем пул HTTP соединений, процессы разбора Excel, хранилище результатов и соединения с БД
+        await close_http_session()
+        excel_executor.shutdown(wait=False, cancel_futures=True)
+        await result_store.close()
+        await auto_renewal.db.close()
+        await db.close()
 
 
 if __name__ == "__main__":
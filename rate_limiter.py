@@ -0,0 +1,161 @@
+"""Модуль ограничения частоты запросов к Wildberries API"""
+import asyncio
+import random
+import time
+from typing import Hashable, Mapping, Optional, Tuple
+
+from cache_helper import TTLCache
+
+
+class TokenBucket:
+    """Token bucket: не более rate запросов в секунду с допустимым всплеском capacity"""
+
+    def __init__(self, rate: float, capacity: int):
+        """
+        Инициализация
+
+        Args:
+            rate: скорость пополнения (запросов в секунду)
+            capacity: размер всплеска (максимум токенов)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        """Пополняет токены за прошедшее время"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, max_wait: Optional[float] = None) -> bool:
+        """
+        Ждет, пока появится токен, и забирает его
+
+        Ожидание идет вне блокировки: остальные запросы не выстраиваются
+        в очередь за одним долгим sleep и после пробуждения проверяют bucket заново.
+
+        Args:
+            max_wait: сколько секунд максимум ждать снятия паузы (None - без ограничения)
+
+        Returns:
+            True - токен получен; False - bucket приостановлен дольше max_wait
+        """
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+
+                # Сервер попросил подождать (429 / исчерпан лимит)
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                    if max_wait is not None and delay > max_wait:
+                        return False
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    delay = (1 - self.tokens) / self.rate
+
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        """Блокирует выдачу токенов на seconds секунд"""
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self._refill(now)
+        self.tokens = 0.0
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        """
+        Учитывает заголовки лимитов WB в ответе
+
+        X-Ratelimit-Remaining: сколько запросов осталось в текущем окне
+        X-Ratelimit-Reset: через сколько секунд лимит восстановится
+        """
+        remaining = _parse_seconds(headers.get('X-Ratelimit-Remaining'))
+        reset = _parse_seconds(headers.get('X-Ratelimit-Reset'))
+
+        if remaining is not None:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = min(self.tokens, remaining)
+
+            if remaining < 1 and reset:
+                self.pause(reset)
+
+
+class RateLimiter:
+    """Набор token bucket'ов по ключу (хост, API ключ)"""
+
+    def __init__(self, limits: Mapping[str, Tuple[float, int]], default_limit: Tuple[float, int],
+                 max_buckets: int = 10000, idle_ttl: float = 3600):
+        """
+        Инициализация
+
+        Args:
+            limits: лимиты по хостам {host: (запросов в секунду, всплеск)}
+            default_limit: лимит для хостов, которых нет в limits
+            max_buckets: максимум одновременно хранимых bucket'ов
+            idle_ttl: через сколько секунд без запросов bucket забывается
+        """
+        self.limits = dict(limits)
+        self.default_limit = default_limit
+        self._buckets = TTLCache(maxsize=max_buckets, ttl=idle_ttl)
+
+    def get_bucket(self, host: str, api_key: Optional[str] = None) -> TokenBucket:
+        """
+        Возвращает bucket для хоста (и API ключа, если лимит считается по токену)
+
+        Args:
+            host: хост WB API
+            api_key: API ключ продавца (None для публичных API)
+        """
+        key: Hashable = (host, api_key)
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            rate, capacity = self.limits.get(host, self.default_limit)
+            bucket = TokenBucket(rate, capacity)
+
+        # Продлеваем жизнь bucket'а при каждом обращении
+        self._buckets.set(key, bucket)
+        return bucket
+
+
+def _parse_seconds(value: Optional[str]) -> Optional[float]:
+    """Разбирает числовое значение заголовка (секунды), None если разобрать нельзя"""
+    if value is None:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_delay(headers: Mapping[str, str]) -> Optional[float]:
+    """
+    Возвращает задержку перед повтором из заголовков ответа
+
+    WB присылает X-Ratelimit-Retry, стандартный вариант - Retry-After (в секундах).
+    """
+    for header in ('X-Ratelimit-Retry', 'Retry-After'):
+        delay = _parse_seconds(headers.get(header))
+        if delay is not None:
+            return delay
+
+    return None
+
+
+def get_backoff_delay(attempt: int, base: float, max_delay: float) -> float:
+    """
+    Экспоненциальная задержка с jitter для попытки attempt (от 0)
+
+    Половина задержки фиксирована, вторая половина случайна, чтобы
+    одновременные запросы не повторялись синхронно.
+    """
+    delay = min(max_delay, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
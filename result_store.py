@@ -0,0 +1,373 @@
+"""Модуль хранения результатов поиска товаров для пагинации"""
+import asyncio
+import json
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+import aiosqlite
+
+# Поля product_info, которые выводятся на странице
+PAGE_INFO_FIELDS = ('excel_category', 'excel_subject', 'entity', 'name', 'excel_commission_wb', 'excel_commission_fbs')
+
+
+def compact_key_result(result: dict) -> dict:
+    """
+    Оставляет от результата ключа только то, что выводится на странице
+
+    Вместо всего product_info и real_prices сохраняются поля показанных
+    товаров и уже рассчитанная СПП.
+
+    Args:
+        result: результат process_single_key (или заглушка no_results)
+
+    Returns:
+        Компактный словарь страницы
+    """
+    page = {
+        'key_name': result['key_name'],
+        'is_default': result.get('is_default', False),
+        'no_results': result.get('no_results', False),
+        'threshold': result.get('threshold', 28),
+        'total_goods': result.get('total_goods', 0),
+        'goods_filtered': result.get('goods_filtered', 0),
+        'items': []
+    }
+
+    product_info = result.get('product_info', {})
+    real_prices = result.get('real_prices', {})
+
+    for product in result.get('unique_goods', []):
+        nm_id = product.get('nmID', 'N/A')
+        info = product_info.get(nm_id, {}) if nm_id != 'N/A' else {}
+
+        item = {'nm_id': nm_id}
+        for field in PAGE_INFO_FIELDS:
+            if info.get(field):
+                item[field] = info[field]
+
+        # СПП = скидка на сайте - скидка продавца
+        price_data = real_prices.get(nm_id) if nm_id != 'N/A' else None
+        if price_data and price_data['basic'] > 0:
+            site_discount = ((price_data['basic'] - price_data['real']) / price_data['basic']) * 100
+            item['spp'] = site_discount - product.get('discount', 0)
+
+        page['items'].append(item)
+
+    return page
+
+
+class MemoryResultBackend:
+    """Страницы в памяти процесса: время жизни записи и общий LRU бюджет памяти"""
+
+    def __init__(self, max_bytes: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        """
+        Инициализация
+
+        Args:
+            max_bytes: бюджет на сжатые страницы всех пользователей (старые вытесняются по LRU)
+            ttl: время жизни результатов пользователя в секундах
+            clock: источник текущего времени в секундах
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()  # user_id -> {'expires_at', 'pages', 'size'}
+        self.total_bytes = 0
+        self.evicted = 0
+
+    def _get_entry(self, user_id: int) -> Optional[dict]:
+        """Возвращает запись пользователя (None, если ее нет или она устарела)"""
+        entry = self._entries.get(user_id)
+
+        if entry is None:
+            return None
+
+        if entry['expires_at'] <= self.clock():
+            self._delete(user_id)
+            return None
+
+        self._entries.move_to_end(user_id)
+        return entry
+
+    def _delete(self, user_id: int):
+        """Удаляет запись пользователя"""
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.total_bytes -= entry['size']
+
+    async def put(self, user_id: int, pages: List[bytes]):
+        """Сохраняет сжатые страницы пользователя"""
+        self._delete(user_id)
+
+        size = sum(len(page) for page in pages)
+        self._entries[user_id] = {
+            'expires_at': self.clock() + self.ttl,
+            'pages': pages,
+            'size': size
+        }
+        self.total_bytes += size
+
+        # Вытесняем давно не просмотренные результаты, последний сохраненный оставляем всегда
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            self._delete(next(iter(self._entries)))
+            self.evicted += 1
+
+    async def get_page(self, user_id: int, page: int) -> Optional[Tuple[Optional[bytes], int]]:
+        """Сжатая страница (None, если ее нет) и количество страниц; None, если результатов нет"""
+        entry = self._get_entry(user_id)
+        if entry is None:
+            return None
+        pages = entry['pages']
+        return (pages[page] if 0 <= page < len(pages) else None), len(pages)
+
+    async def page_count(self, user_id: int) -> Optional[int]:
+        """Количество страниц (None, если результатов нет)"""
+        entry = self._get_entry(user_id)
+        return len(entry['pages']) if entry is not None else None
+
+    async def delete(self, user_id: int):
+        """Удаляет результаты пользователя"""
+        self._delete(user_id)
+
+    async def close(self):
+        """Освобождает ресурсы (для памяти ничего не нужно)"""
+
+    async def get_stats(self) -> Dict[str, int]:
+        """Статистика хранилища"""
+        return {
+            'users': len(self._entries),
+            'bytes': self.total_bytes,
+            'evicted': self.evicted
+        }
+
+
+class SQLiteResultBackend:
+    """
+    Страницы в файле SQLite
+
+    Результаты переживают перезапуск бота и доступны всем процессам,
+    работающим с тем же файлом. Время жизни считается по часам системы.
+    """
+
+    def __init__(self, path: str, ttl: float, busy_timeout: float = 5, clock: Callable[[], float] = time.time):
+        """
+        Инициализация
+
+        Args:
+            path: путь к файлу базы результатов
+            ttl: время жизни результатов пользователя в секундах
+            busy_timeout: сколько секунд ждать освобождения блокировки другим процессом
+            clock: источник текущего времени в секундах (общий для всех процессов)
+        """
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self.busy_timeout = busy_timeout
+        self._connection = None
+        self._lock = asyncio.Lock()
+
+    async def _open(self) -> aiosqlite.Connection:
+        """Открывает соединение и создает таблицы, если это еще не сделано"""
+        if self._connection is None:
+            connection = await aiosqlite.connect(self.path, timeout=self.busy_timeout)
+            await connection.execute('PRAGMA journal_mode=WAL')
+            await connection.execute('PRAGMA synchronous=NORMAL')
+            await connection.execute(f'PRAGMA busy_timeout={int(self.busy_timeout * 1000)}')
+            await connection.execute('''
+                CREATE TABLE IF NOT EXISTS result_entries (
+                    user_id INTEGER PRIMARY KEY,
+                    page_count INTEGER NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            await connection.execute('''
+                CREATE TABLE IF NOT EXISTS result_pages (
+                    user_id INTEGER NOT NULL,
+                    page INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (user_id, page)
+                ) WITHOUT ROWID
+            ''')
+            await connection.execute(
+                'CREATE INDEX IF NOT EXISTS idx_result_entries_expires ON result_entries(expires_at)'
+            )
+            await connection.commit()
+            self._connection = connection
+        return self._connection
+
+    @asynccontextmanager
+    async def _connect(self):
+        """Выдает общее соединение на время блока запросов (с откатом при ошибке)"""
+        async with self._lock:
+            connection = await self._open()
+            try:
+                yield connection
+            except BaseException:
+                await connection.rollback()
+                raise
+
+    async def put(self, user_id: int, pages: List[bytes]):
+        """Сохраняет сжатые страницы пользователя и удаляет устаревшие результаты"""
+        now = self.clock()
+
+        async with self._connect() as db:
+            await db.execute(
+                'DELETE FROM result_pages WHERE user_id IN '
+                '(SELECT user_id FROM result_entries WHERE expires_at <= ?) OR user_id = ?',
+                (now, user_id)
+            )
+            await db.execute('DELETE FROM result_entries WHERE expires_at <= ? OR user_id = ?', (now, user_id))
+            await db.execute(
+                'INSERT INTO result_entries (user_id, page_count, expires_at) VALUES (?, ?, ?)',
+                (user_id, len(pages), now + self.ttl)
+            )
+            await db.executemany(
+                'INSERT INTO result_pages (user_id, page, data) VALUES (?, ?, ?)',
+                [(user_id, page, data) for page, data in enumerate(pages)]
+            )
+            await db.commit()
+
+    async def get_page(self, user_id: int, page: int) -> Optional[Tuple[Optional[bytes], int]]:
+        """Сжатая страница (None, если ее нет) и количество страниц; None, если результатов нет или они устарели"""
+        async with self._connect() as db:
+            async with db.execute(
+                '''SELECT p.data, e.page_count FROM result_entries e
+                   LEFT JOIN result_pages p ON p.user_id = e.user_id AND p.page = ?
+                   WHERE e.user_id = ? AND e.expires_at > ?''',
+                (page, user_id, self.clock())
+            ) as cursor:
+                row = await cursor.fetchone()
+                return (row[0], row[1]) if row else None
+
+    async def page_count(self, user_id: int) -> Optional[int]:
+        """Количество страниц (None, если результатов нет или они устарели)"""
+        async with self._connect() as db:
+            async with db.execute(
+                'SELECT page_count FROM result_entries WHERE user_id = ? AND expires_at > ?',
+                (user_id, self.clock())
+            ) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else None
+
+    async def delete(self, user_id: int):
+        """Удаляет результаты пользователя"""
+        async with self._connect() as db:
+            await db.execute('DELETE FROM result_pages WHERE user_id = ?', (user_id,))
+            await db.execute('DELETE FROM result_entries WHERE user_id = ?', (user_id,))
+            await db.commit()
+
+    async def close(self):
+        """Закрывает соединение (при остановке бота)"""
+        async with self._lock:
+            if self._connection is not None:
+                await self._connection.close()
+                self._connection = None
+
+    async def get_stats(self) -> Dict[str, int]:
+        """Статистика хранилища"""
+        async with self._connect() as db:
+            async with db.execute(
+                '''SELECT COUNT(DISTINCT e.user_id), COALESCE(SUM(LENGTH(p.data)), 0)
+                   FROM result_entries e JOIN result_pages p ON p.user_id = e.user_id
+                   WHERE e.expires_at > ?''',
+                (self.clock(),)
+            ) as cursor:
+                users, size = await cursor.fetchone()
+                return {'users': users, 'bytes': size}
+
+
+class ResultStore:
+    """Страницы результатов поиска по пользователям, хранение делегируется backend'у"""
+
+    def __init__(self, backend):
+        """
+        Инициализация
+
+        Args:
+            backend: MemoryResultBackend или SQLiteResultBackend
+        """
+        self.backend = backend
+
+    @staticmethod
+    def _pack(page: dict) -> bytes:
+        """Сжатый JSON страницы"""
+        return zlib.compress(json.dumps(page, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    @staticmethod
+    def _unpack(data: bytes) -> dict:
+        """Страница из сжатого JSON"""
+        return json.loads(zlib.decompress(data).decode('utf-8'))
+
+    async def put(self, user_id: int, pages: List[dict]):
+        """
+        Сохраняет страницы результатов пользователя
+
+        Args:
+            user_id: ID пользователя
+            pages: страницы по порядку (словари, сериализуемые в JSON)
+        """
+        await self.backend.put(user_id, [self._pack(page) for page in pages])
+
+    async def get_page(self, user_id: int, page: int) -> Optional[Tuple[Optional[dict], int]]:
+        """
+        Возвращает страницу результатов вместе с количеством страниц (одним чтением)
+
+        Args:
+            user_id: ID пользователя
+            page: номер страницы (от 0)
+
+        Returns:
+            (словарь страницы или None, если такой страницы нет; количество страниц)
+            или None, если результатов нет
+        """
+        found = await self.backend.get_page(user_id, page)
+        if found is None:
+            return None
+        data, total_pages = found
+        return (self._unpack(data) if data is not None else None), total_pages
+
+    async def page_count(self, user_id: int) -> Optional[int]:
+        """Количество страниц пользователя (None, если результатов нет)"""
+        return await self.backend.page_count(user_id)
+
+    async def delete(self, user_id: int):
+        """Удаляет результаты пользователя"""
+        await self.backend.delete(user_id)
+
+    async def close(self):
+        """Закрывает backend (при остановке бота)"""
+        await self.backend.close()
+
+    async def get_stats(self) -> Dict[str, int]:
+        """
+        Возвращает статистику хранилища
+
+        Returns:
+            Словарь со статистикой
+        """
+        return await self.backend.get_stats()
+
+
+def create_result_store(backend: str, path: str, max_bytes: int, ttl: float) -> ResultStore:
+    """
+    Создает хранилище результатов с нужным backend'ом
+
+    Args:
+        backend: 'memory' (в памяти процесса) или 'sqlite' (файл path)
+        path: путь к файлу для backend'а sqlite
+        max_bytes: бюджет памяти для backend'а memory
+        ttl: время жизни результатов пользователя в секундах
+
+    Returns:
+        ResultStore
+    """
+    if backend == 'memory':
+        return ResultStore(MemoryResultBackend(max_bytes=max_bytes, ttl=ttl))
+
+    if backend == 'sqlite':
+        return ResultStore(SQLiteResultBackend(path, ttl=ttl))
+
+    raise ValueError(f"Неизвестный backend хранилища результатов: {backend}")
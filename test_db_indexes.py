@@ -0,0 +1,80 @@
+"""Тест миграции индексов: горячие запросы должны использовать индексы, а не полный просмотр таблиц"""
+import asyncio
+import os
+import sqlite3
+import tempfile
+
+import config
+
+# Без ключа CryptoHelper сгенерирует новый и запишет его в .env
+# (config мог быть уже импортирован другим тестом, поэтому ключ задается в нем напрямую)
+config.ENCRYPTION_KEY = config.ENCRYPTION_KEY or 'dGVzdC1rZXktdGVzdC1rZXktdGVzdC1rZXktdGVzdDE='
+
+import database  # noqa: E402
+from database import Database, MIGRATIONS  # noqa: E402
+
+# (запрос из database.py, параметры, индексы, которые должны использоваться)
+HOT_QUERIES = [
+    ('ACTIVE_SUBSCRIPTION_QUERY', (1, '2026-01-01'), ['idx_subscriptions_user_status_end']),
+    (
+        'EXPIRING_SUBSCRIPTIONS_QUERY',
+        ('2026-01-01', '2026-01-04'),
+        ['idx_subscriptions_status_end', 'idx_subscriptions_status_user_id']
+    ),
+    (
+        'USER_CONTEXT_QUERY',
+        {'user_id': 1, 'now': '2026-01-01'},
+        ['idx_subscriptions_user_status_end', 'idx_api_keys_user_active']
+    ),
+    ('ACTIVE_API_KEYS_QUERY', (1,), ['idx_api_keys_user_active']),
+    ('USER_PAYMENTS_QUERY', (1, 10), ['idx_payments_user_created']),
+    ('USER_PAYMENT_METHODS_QUERY', (1,), ['idx_payment_methods_user_active']),
+    ('EXCEL_FILE_REFERENCES_QUERY', ('user_files/abc.xlsx',), ['idx_users_excel_file_path']),
+]
+
+# Таблицы, полный просмотр которых недопустим
+TABLES = ('users', 'subscriptions', 'api_keys', 'payments', 'payment_methods')
+
+
+def create_database(path: str):
+    """Создает схему через Database.create_tables"""
+    async def run():
+        db = Database(path)
+        await db.connect()
+        try:
+            await db.create_tables()
+            # Повторный запуск не должен падать и повторно применять миграции
+            await db.create_tables()
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_hot_queries_use_indexes():
+    """EXPLAIN QUERY PLAN каждого горячего запроса из database.py содержит нужные индексы и не просматривает таблицы целиком"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'test.db')
+        create_database(path)
+
+        conn = sqlite3.connect(path)
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            assert version == MIGRATIONS[-1][0], version
+
+            for name, params, index_names in HOT_QUERIES:
+                query = getattr(database, name)
+                details = [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params)]
+                plan = ' | '.join(details)
+
+                for index_name in index_names:
+                    assert index_name in plan, f'{name}: {plan}'
+                for detail in details:
+                    assert not any(detail.startswith(f'SCAN {table}') for table in TABLES), f'{name}: {plan}'
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    test_hot_queries_use_indexes()
+    print("✅ Горячие запросы используют индексы")
@@ -0,0 +1,98 @@
+"""Тест ограничения частоты запросов и повторов WB API на локальном сервере"""
+import asyncio
+import time
+
+from aiohttp import web
+
+import wb_api
+from rate_limiter import TokenBucket
+from wb_api import RATE_LIMITED_TEXT, WildberriesAPI
+
+
+def test_long_pause_fails_fast():
+    """Пауза дольше max_wait не ждется, остальные ожидающие не блокируются одним sleep"""
+    async def run():
+        bucket = TokenBucket(rate=100, capacity=1)
+        bucket.pause(100)
+
+        started = time.monotonic()
+        assert await bucket.acquire(max_wait=1) is False
+        assert time.monotonic() - started < 0.1
+
+        # Короткая пауза: несколько ожидающих получают токены сразу после ее окончания
+        bucket = TokenBucket(rate=100, capacity=3)
+        bucket.pause(0.2)
+        started = time.monotonic()
+        results = await asyncio.gather(*(bucket.acquire(max_wait=1) for _ in range(3)))
+        assert results == [True, True, True]
+        assert time.monotonic() - started < 0.5
+
+    asyncio.run(run())
+
+
+async def start_server(responses):
+    """Локальный сервер, отвечающий по очереди из responses: (статус, заголовки)"""
+    calls = []
+
+    async def handler(request):
+        calls.append(time.monotonic())
+        status, headers = responses[min(len(calls), len(responses)) - 1]
+        return web.Response(status=status, text='{}', headers=headers)
+
+    app = web.Application()
+    app.router.add_get('/', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}/', calls
+
+
+def test_retry_after_errors():
+    """429 и 5xx с короткой задержкой повторяются до успешного ответа"""
+    async def run():
+        runner, url, calls = await start_server([
+            (429, {'X-Ratelimit-Retry': '0.1'}),
+            (503, {'Retry-After': '0'}),
+            (200, {}),
+        ])
+        try:
+            status, _ = await WildberriesAPI('retry-key')._request(url, headers={}, params={}, api_key='retry-key')
+            assert status == 200
+            assert len(calls) == 3
+        finally:
+            await wb_api.close_http_session()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_long_retry_fails_fast():
+    """429 с долгим X-Ratelimit-Retry сразу возвращается, следующие запросы не ждут паузу"""
+    async def run():
+        runner, url, calls = await start_server([(429, {'X-Ratelimit-Retry': '100'})])
+        api = WildberriesAPI('long-key')
+        try:
+            started = time.monotonic()
+            status, _ = await api._request(url, headers={}, params={}, api_key='long-key')
+            assert status == 429
+
+            status, text = await asyncio.wait_for(
+                api._request(url, headers={}, params={}, api_key='long-key'), timeout=5
+            )
+            assert (status, text) == (429, RATE_LIMITED_TEXT)
+            assert time.monotonic() - started < 1
+            assert len(calls) == 1  # второй запрос до WB не дошел
+        finally:
+            await wb_api.close_http_session()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_long_pause_fails_fast()
+    test_retry_after_errors()
+    test_long_retry_fails_fast()
+    print("✅ Лимиты и повторы работают")
@@ -0,0 +1,133 @@
+"""Тест разбиения страницы результатов на части по лимиту сообщения Telegram и кнопок частей"""
+import asyncio
+import re
+from types import SimpleNamespace
+
+import config
+
+# main создает бота при импорте, а CryptoHelper без ключа записал бы новый в .env
+# (config мог быть уже импортирован другим тестом, поэтому значения задаются в нем напрямую)
+config.BOT_TOKEN = config.BOT_TOKEN or '123456:TEST'
+config.ENCRYPTION_KEY = config.ENCRYPTION_KEY or 'dGVzdC1rZXktdGVzdC1rZXktdGVzdC1rZXktdGVzdDE='
+
+import main  # noqa: E402
+from config import RESULT_PAGE_MAX_LENGTH  # noqa: E402
+from keyboards import get_pagination_keyboard  # noqa: E402
+from main import render_page_texts, utf16_length  # noqa: E402
+
+
+def make_page(items: list) -> dict:
+    """Компактная страница ключа (см. compact_key_result)"""
+    return {
+        'key_name': 'Ключ',
+        'is_default': False,
+        'no_results': False,
+        'threshold': 30,
+        'total_goods': len(items) * 10,
+        'goods_filtered': len(items),
+        'items': items
+    }
+
+
+def make_item(nm_id: int, name: str) -> dict:
+    """Товар с полями, которые выводятся на странице"""
+    return {
+        'nm_id': nm_id,
+        'excel_category': 'Дом 🏠',
+        'excel_subject': 'Коврики 🧶',
+        'name': name,
+        'excel_commission_wb': '25%',
+        'excel_commission_fbs': '27%',
+        'spp': 12.5
+    }
+
+
+def item_numbers(texts: list) -> list:
+    """Номера товаров по порядку во всех частях"""
+    return [int(number) for text in texts for number in re.findall(r'^(\d+)\. ', text, re.MULTILINE)]
+
+
+def test_parts_fit_limit():
+    """Каждая часть не длиннее лимита в UTF-16 (эмодзи занимают 2 code units), нумерация сквозная"""
+    items = [make_item(nm_id, f'Товар {nm_id} ' + '🔥😀🎉' * (nm_id % 40)) for nm_id in range(400)]
+    texts = render_page_texts(make_page(items), page=1, total_pages=3)
+
+    assert len(texts) > 1
+    for sub_page, text in enumerate(texts):
+        assert utf16_length(text) <= RESULT_PAGE_MAX_LENGTH, (sub_page, utf16_length(text))
+        assert f'Страница 2/3 (часть {sub_page + 1}/{len(texts)})' in text
+
+    assert item_numbers(texts) == list(range(1, 401))
+
+
+def test_oversized_product_truncated():
+    """Товар длиннее сообщения обрезается, но не пропадает; следующий товар идет со своим номером"""
+    items = [make_item(1, '🔥' * 5000), make_item(2, 'Обычный товар')]
+    texts = render_page_texts(make_page(items), page=0, total_pages=1)
+
+    assert all(utf16_length(text) <= RESULT_PAGE_MAX_LENGTH for text in texts)
+    assert '…' in texts[0]
+    assert item_numbers(texts) == [1, 2]
+    assert 'Обычный товар' in texts[-1]
+
+
+def test_empty_page_single_part():
+    """Без товаров (и без результатов) страница состоит из одной части"""
+    texts = render_page_texts(make_page([]), page=0, total_pages=1)
+    assert len(texts) == 1 and 'показано: 0' in texts[0] and 'часть' not in texts[0]
+
+    no_results = dict(make_page([]), no_results=True)
+    assert len(render_page_texts(no_results, page=0, total_pages=1)) == 1
+
+
+def test_keyboard_callbacks():
+    """Кнопки частей и страниц передают page:{страница}:{часть}"""
+    keyboard = get_pagination_keyboard(1, 3, 'Ключ', current_sub_page=1, total_sub_pages=3)
+    rows = [[button.callback_data for button in row] for row in keyboard.inline_keyboard]
+
+    assert rows == [
+        ['page:1:0', 'noop', 'page:1:2'],
+        ['page:0:0', 'noop', 'page:2:0'],
+    ]
+
+    # Одна часть: строки частей нет
+    keyboard = get_pagination_keyboard(0, 1)
+    assert [[button.callback_data for button in row] for row in keyboard.inline_keyboard] == [['noop']]
+
+
+def test_handler_accepts_old_buttons():
+    """Обработчик понимает и новые кнопки page:{p}:{s}, и старые page:{p} из уже отправленных сообщений"""
+    shown = []
+
+    async def fake_show_page(callback, user_id, page, sub_page=0):
+        shown.append((user_id, page, sub_page))
+
+    async def has_active_subscription(user_id):
+        return True
+
+    async def answer(*args, **kwargs):
+        pass
+
+    async def run():
+        for data in ('page:3', 'page:3:2'):
+            callback = SimpleNamespace(from_user=SimpleNamespace(id=7), data=data, answer=answer)
+            await main.pagination_handler(callback)
+
+    original_show_page, original_db = main.show_page, main.db
+    main.show_page = fake_show_page
+    main.db = SimpleNamespace(has_active_subscription=has_active_subscription)
+    try:
+        asyncio.run(run())
+    finally:
+        main.show_page, main.db = original_show_page, original_db
+
+    assert shown == [(7, 3, 0), (7, 3, 2)]
+
+
+if __name__ == "__main__":
+    test_parts_fit_limit()
+    test_oversized_product_truncated()
+    test_empty_page_single_part()
+    test_keyboard_callbacks()
+    test_handler_accepts_old_buttons()
+    print("✅ Части страниц помещаются в сообщение")
@@ -0,0 +1,131 @@
+"""Тест хранилища результатов поиска: компактные страницы, TTL и вытеснение по бюджету памяти"""
+import asyncio
+import os
+import tempfile
+
+from result_store import (
+    MemoryResultBackend, ResultStore, SQLiteResultBackend, compact_key_result, create_result_store
+)
+
+
+def make_result(key_name: str, count: int) -> dict:
+    """Результат process_single_key с count товарами"""
+    goods = [{'nmID': nm_id, 'discount': 10} for nm_id in range(count)]
+    return {
+        'key_name': key_name,
+        'stats_text': 'статистика',
+        'unique_goods': goods,
+        'product_info': {
+            nm_id: {'entity': f'Предмет {nm_id}', 'name': f'Товар {nm_id}', 'brand': 'Бренд', 'subjectId': 1}
+            for nm_id in range(count * 10)
+        },
+        'real_prices': {nm_id: {'real': 500.0, 'basic': 1000.0} for nm_id in range(count * 10)},
+        'total_goods': count * 10,
+        'goods_filtered': count,
+        'threshold': 30,
+        'is_default': False
+    }
+
+
+def test_compact_page():
+    """На странице остаются только показанные товары и рассчитанная СПП"""
+    page = compact_key_result(make_result('Ключ', 2))
+
+    assert page['items'] == [
+        {'nm_id': 0, 'entity': 'Предмет 0', 'name': 'Товар 0', 'spp': 40.0},
+        {'nm_id': 1, 'entity': 'Предмет 1', 'name': 'Товар 1', 'spp': 40.0},
+    ]
+    assert page['total_goods'] == 20 and page['goods_filtered'] == 2 and page['threshold'] == 30
+
+
+class FakeClock:
+    """Часы, которые двигаются только вручную (TTL проверяется без sleep)"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+async def check_pages_and_ttl(store: ResultStore, clock: FakeClock):
+    """Страницы читаются по номеру и пропадают после TTL"""
+    await store.put(1, [compact_key_result(make_result('A', 3)), compact_key_result(make_result('B', 0))])
+
+    assert await store.page_count(1) == 2
+    page, total_pages = await store.get_page(1, 0)
+    assert page['key_name'] == 'A' and total_pages == 2
+    assert await store.get_page(1, 2) == (None, 2)
+
+    clock.now += 59
+    assert await store.page_count(1) == 2
+
+    clock.now += 1
+    assert await store.page_count(1) is None
+    assert await store.get_page(1, 0) is None
+
+
+def test_memory_pages_and_ttl():
+    clock = FakeClock()
+    store = ResultStore(MemoryResultBackend(max_bytes=10 * 1024 * 1024, ttl=60, clock=clock))
+    asyncio.run(check_pages_and_ttl(store, clock))
+
+
+def test_sqlite_pages_and_ttl():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        async def run():
+            clock = FakeClock()
+            store = ResultStore(SQLiteResultBackend(os.path.join(tmp_dir, 'results.db'), ttl=60, clock=clock))
+            try:
+                await check_pages_and_ttl(store, clock)
+            finally:
+                await store.close()
+
+        asyncio.run(run())
+
+
+def test_sqlite_survives_restart():
+    """Результаты из файла доступны новому экземпляру (перезапуск или другой процесс)"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'results.db')
+
+        async def run():
+            writer = create_result_store('sqlite', path, max_bytes=0, ttl=3600)
+            await writer.put(1, [compact_key_result(make_result('A', 3))])
+            await writer.close()
+
+            reader = create_result_store('sqlite', path, max_bytes=0, ttl=3600)
+            found = await reader.get_page(1, 0)
+            await reader.close()
+            return found
+
+        assert asyncio.run(run()) == (compact_key_result(make_result('A', 3)), 1)
+
+
+def test_lru_byte_budget():
+    """При превышении бюджета вытесняются давно не просмотренные пользователи"""
+    async def run():
+        backend = MemoryResultBackend(max_bytes=10 * 1024 * 1024, ttl=3600)
+        await ResultStore(backend).put(1, [compact_key_result(make_result('A', 200))])
+        size = backend.total_bytes
+
+        store = ResultStore(MemoryResultBackend(max_bytes=size * 2, ttl=3600))
+        await store.put(1, [compact_key_result(make_result('A', 200))])
+        await store.put(2, [compact_key_result(make_result('B', 200))])
+        await store.get_page(1, 0)  # пользователь 1 просматривал результаты позже
+        await store.put(3, [compact_key_result(make_result('C', 200))])
+
+        assert await store.page_count(1) and await store.page_count(3)
+        assert await store.page_count(2) is None
+        assert (await store.get_stats())['bytes'] <= size * 2
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_compact_page()
+    test_memory_pages_and_ttl()
+    test_sqlite_pages_and_ttl()
+    test_sqlite_survives_restart()
+    test_lru_byte_budget()
+    print("✅ Хранилище результатов работает")
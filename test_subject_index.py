@@ -0,0 +1,74 @@
+"""Тест индексированного поиска предметов: результат должен совпадать с последовательным перебором"""
+import random
+
+from excel_helper import ExcelHelper
+
+
+def find_by_scan(helper: ExcelHelper, entity: str):
+    """Прежний поиск перебором всех строк (эталон)"""
+    data = helper.load_data()
+    entity_key = str(entity).strip().lower()
+
+    if entity_key in data:
+        return data.get(entity_key)
+
+    entity_normalized = helper._normalize_text(entity)
+
+    for key, value in data.items():
+        key_normalized = helper._normalize_text(key)
+
+        if entity_normalized == key_normalized:
+            return value
+
+        if entity_normalized in key_normalized or key_normalized in entity_normalized:
+            if abs(len(entity_normalized) - len(key_normalized)) <= 3:
+                return value
+
+    return None
+
+
+def make_helper(subjects) -> ExcelHelper:
+    """ExcelHelper с данными в памяти, без файла"""
+    helper = ExcelHelper("unused.xlsx")
+    helper.data_cache = {
+        subject.strip().lower(): {
+            'category': f'Категория {idx}',
+            'subject': subject,
+            'commission_wb': '',
+            'commission_fbs': '',
+            'commission_self': ''
+        }
+        for idx, subject in enumerate(subjects)
+    }
+    return helper
+
+
+def test_known_cases():
+    """Примеры из реальных файлов комиссий"""
+    helper = make_helper(['Коврики для ванной', 'Домкраты', 'Вибраторы', 'Лонгсливы', 'Футболки', 'Линии'])
+
+    for entity in ['Коврик для ванной', 'домкрат', 'вибратор', 'лонгслив', 'футболка', 'линия', 'нет такого']:
+        assert helper.find_by_subject(entity) is find_by_scan(helper, entity), entity
+
+
+def test_random_equivalence():
+    """Случайные названия: индекс выбирает ту же строку, что и перебор"""
+    rnd = random.Random(42)
+    alphabet = 'абвгдиыкс '
+
+    def word():
+        return ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(1, 9)))
+
+    subjects = [word() for _ in range(400)]
+    subjects = [s for s in subjects if s.strip()]
+    helper = make_helper(subjects)
+
+    entities = [word() for _ in range(2000)] + [s[1:] for s in subjects] + [s + 'ы' for s in subjects]
+    for entity in entities:
+        assert helper.find_by_subject(entity) is find_by_scan(helper, entity), repr(entity)
+
+
+if __name__ == "__main__":
+    test_known_cases()
+    test_random_equivalence()
+    print("✅ Индексированный поиск совпадает с перебором")
@@ -1,13 +1,154 @@
 """Модуль для работы с Wildberries API"""
 import aiohttp
-import ssl
-import requests
+import asyncio
+import json
 import logging
-from typing import Dict, List
-from config import WB_API_DISCOUNTS_URL
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+from cache_helper import RequestCoalescer, TTLCache
+from rate_limiter import RateLimiter, get_backoff_delay, get_retry_delay
+from config import (
+    WB_API_DISCOUNTS_URL,
+    WB_HTTP_POOL_LIMIT,
+    WB_HTTP_POOL_LIMIT_PER_HOST,
+    WB_HTTP_KEEPALIVE_TIMEOUT,
+    WB_HTTP_DNS_CACHE_TTL,
+    WB_RATE_LIMITS,
+    WB_RATE_LIMIT_DEFAULT,
+    WB_RETRY_ATTEMPTS,
+    WB_RETRY_BASE_DELAY,
+    WB_RETRY_MAX_DELAY,
+    WB_CARDS_BATCH_SIZE,
+    WB_CARDS_MAX_CONCURRENCY,
+    WB_CARDS_CACHE_TTL,
+    WB_CARDS_CACHE_MAX_SIZE,
+    WB_GOODS_PAGE_SIZE,
+    WB_GOODS_PREFETCH_PAGES,
+    DEFAULT_API_KEYS,
+    DEFAULT_GOODS_CACHE_TTL
+)
 
 logger = logging.getLogger(__name__)
 
+# Текст ответа, если запрос не выполнялся из-за долгой паузы по лимиту WB
+RATE_LIMITED_TEXT = 'rate limited'
+
+# Таймаут запроса к Cards API (как у прежней синхронной реализации)
+CARDS_API_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+# Кэш карточек Cards API: nmID -> компактная карточка (цена, предмет, бренд, название, id предмета)
+cards_cache = TTLCache(maxsize=WB_CARDS_CACHE_MAX_SIZE, ttl=WB_CARDS_CACHE_TTL)
+
+# Кэш полных списков товаров дефолтных ключей: api_key -> результат get_all_goods
+default_goods_cache = TTLCache(maxsize=max(len(DEFAULT_API_KEYS), 1), ttl=DEFAULT_GOODS_CACHE_TTL)
+
+# Лимиты частоты запросов по хосту и API ключу
+rate_limiter = RateLimiter(WB_RATE_LIMITS, WB_RATE_LIMIT_DEFAULT)
+
+# Объединение одинаковых одновременных запросов к WB (listGoods и пачки Cards API)
+request_coalescer = RequestCoalescer()
+
+# Общая HTTP сессия процесса (пул соединений с keep-alive и DNS кэшем)
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+async def init_http_session() -> aiohttp.ClientSession:
+    """
+    Создает общую HTTP сессию для всех запросов к WB API
+
+    Вызывается при старте бота. Повторный вызов возвращает уже открытую сессию.
+    """
+    global _http_session
+
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=WB_HTTP_POOL_LIMIT,
+            limit_per_host=WB_HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=WB_HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=WB_HTTP_DNS_CACHE_TTL,
+            use_dns_cache=True
+        )
+        _http_session = aiohttp.ClientSession(connector=connector)
+        logger.info("HTTP сессия WB API создана")
+
+    return _http_session
+
+
+async def close_http_session():
+    """Закрывает общую HTTP сессию (при остановке бота)"""
+    global _http_session
+
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+        logger.info("HTTP сессия WB API закрыта")
+
+    _http_session = None
+
+
+def _compact_card(card: Dict) -> Dict:
+    """Оставляет в карточке Cards API только поля, которые использует бот"""
+    compact = {
+        'id': card.get('id'),
+        'entity': card.get('entity', ''),
+        'brand': card.get('brand', ''),
+        'name': card.get('name', ''),
+        'subjectId': card.get('subjectId', ''),
+        'subjectParentId': card.get('subjectParentId', '')
+    }
+
+    # В v4 API цена находится в sizes[0].price
+    sizes = card.get('sizes', [])
+    if sizes:
+        compact['sizes'] = [{'price': sizes[0].get('price', {})}]
+
+    return compact
+
+
+def merge_cards_results(results: List[Dict]) -> Dict:
+    """
+    Объединяет результаты нескольких запросов к Cards API в один
+
+    Списки products складываются, неудачные запросы пропускаются.
+    Ошибка возвращается только если не удался ни один запрос.
+
+    Args:
+        results: результаты get_cards_detail / отдельных пачек
+
+    Returns:
+        Словарь того же вида, что и у get_cards_detail
+    """
+    merged_data = None
+    products = []
+    errors = []
+
+    for result in results:
+        if not result['success']:
+            errors.append(result['error'])
+            continue
+
+        data = result['data']
+        if merged_data is None:
+            merged_data = dict(data)
+        products.extend(data.get('products', []))
+
+    if merged_data is None:
+        if errors:
+            # Все запросы завершились ошибкой
+            return {
+                'success': False,
+                'error': errors[0]
+            }
+        merged_data = {}
+
+    if 'products' in merged_data or products or not results:
+        merged_data['products'] = products
+
+    return {
+        'success': True,
+        'data': merged_data
+    }
+
 
 class WildberriesAPI:
     def __init__(self, api_key: str):
@@ -17,11 +158,76 @@ class WildberriesAPI:
             'Content-Type': 'application/json'
         }
 
+    async def _request(self, url: str, headers: Dict, params: Dict, api_key: Optional[str] = None,
+                       **kwargs) -> Tuple[int, str]:
+        """
+        GET запрос к WB через общий пул с учетом лимитов и повторами
+
+        Перед каждой попыткой берется токен из bucket'а (хост + API ключ).
+        При 429, 5xx и ошибках соединения запрос повторяется до WB_RETRY_ATTEMPTS раз:
+        задержка берется из X-Ratelimit-Retry / Retry-After, иначе экспоненциальная с jitter.
+
+        Args:
+            url: адрес запроса
+            headers: заголовки
+            params: query параметры
+            api_key: API ключ, если лимит хоста считается по токену
+            **kwargs: дополнительные аргументы session.get (ssl, timeout)
+
+        Returns:
+            (HTTP статус, текст ответа) последней попытки
+        """
+        host = urlsplit(url).hostname
+        bucket = rate_limiter.get_bucket(host, api_key)
+        session = await init_http_session()
+
+        for attempt in range(WB_RETRY_ATTEMPTS + 1):
+            # Если WB попросил ждать дольше WB_RETRY_MAX_DELAY - сразу возвращаем ошибку,
+            # а не держим запрос (и слоты параллельной обработки ключей) до конца паузы
+            if not await bucket.acquire(max_wait=WB_RETRY_MAX_DELAY):
+                logger.warning(f"WB {host}: лимит запросов исчерпан, запрос не выполнен")
+                return 429, RATE_LIMITED_TEXT
+
+            try:
+                async with session.get(url, headers=headers, params=params, **kwargs) as response:
+                    response_text = await response.text()
+                    bucket.update_from_headers(response.headers)
+                    status = response.status
+                    retry_delay = get_retry_delay(response.headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == WB_RETRY_ATTEMPTS:
+                    raise
+                delay = get_backoff_delay(attempt, WB_RETRY_BASE_DELAY, WB_RETRY_MAX_DELAY)
+                logger.warning(f"WB {host}: ошибка соединения ({e!r}), повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                continue
+
+            if status != 429 and status < 500:
+                return status, response_text
+
+            if retry_delay is None:
+                retry_delay = get_backoff_delay(attempt, WB_RETRY_BASE_DELAY, WB_RETRY_MAX_DELAY)
+
+            if status == 429:
+                # Лимит исчерпан: приостанавливаем все запросы этого ключа к хосту.
+                # Повтор дождется токена в bucket.acquire(); если пауза длиннее
+                # WB_RETRY_MAX_DELAY, этот и следующие запросы сразу вернут 429
+                bucket.pause(retry_delay)
+
+            if attempt == WB_RETRY_ATTEMPTS or retry_delay > WB_RETRY_MAX_DELAY:
+                return status, response_text
+
+            logger.warning(f"WB {host}: ответ {status}, попытка {attempt + 1}, повтор через {retry_delay:.1f} с")
+            if status != 429:
+                await asyncio.sleep(retry_delay)
+
     async def get_goods_list(self, limit: int = 1000, offset: int = 0) -> Dict:
         """
         Получение списка товаров с ценами и скидками
         GET https://discounts-prices-api.wildberries.ru/api/v2/list/goods/filter
 
+        Одновременные вызовы с тем же ключом и параметрами выполняются одним запросом.
+
         Args:
             limit: количество товаров на странице (макс 1000)
             offset: смещение относительно первого элемента
@@ -29,6 +235,13 @@ class WildberriesAPI:
         Returns:
             Словарь с данными о товарах
         """
+        return await request_coalescer.run(
+            ('goods', self.api_key, limit, offset),
+            lambda: self._get_goods_list(limit, offset)
+        )
+
+    async def _get_goods_list(self, limit: int, offset: int) -> Dict:
+        """Один запрос к listGoods (без объединения)"""
         url = f'{WB_API_DISCOUNTS_URL}/api/v2/list/goods/filter'
 
         # Query параметры
@@ -38,34 +251,223 @@ class WildberriesAPI:
         }
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    url,
-                    headers=self.headers,
-                    params=params
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return {
-                            'success': True,
-                            'data': data
-                        }
-                    else:
-                        error_text = await response.text()
-                        return {
-                            'success': False,
-                            'error': f'Ошибка API {response.status}: {error_text}'
-                        }
+            status, response_text = await self._request(url, headers=self.headers, params=params,
+                                                        api_key=self.api_key)
+            if status == 200:
+                return {
+                    'success': True,
+                    'data': json.loads(response_text)
+                }
+            else:
+                return {
+                    'success': False,
+                    'error': f'Ошибка API {status}: {response_text}'
+                }
         except Exception as e:
             return {
                 'success': False,
                 'error': f'Ошибка соединения: {str(e)}'
             }
 
-    def _get_cards_detail_sync(self, nm_ids: List[int]) -> Dict:
+    async def iter_goods_pages(self, limit: int = WB_GOODS_PAGE_SIZE,
+                               prefetch: int = WB_GOODS_PREFETCH_PAGES) -> AsyncIterator[Dict]:
+        """
+        Постраничный обход всего списка товаров (listGoods)
+
+        offset увеличивается, пока страница не окажется короче limit.
+        После первой полной страницы следующие prefetch страниц запрашиваются
+        заранее параллельно. Страницы отдаются по порядку по мере получения,
+        поэтому обработку можно начинать до загрузки всего каталога.
+
+        Args:
+            limit: количество товаров на странице (макс 1000)
+            prefetch: сколько следующих страниц запрашивать заранее (0 - последовательно)
+
+        Yields:
+            {'success': True, 'offset': int, 'goods': [...]} для каждой страницы,
+            либо {'success': False, 'offset': int, 'error': str} - после ошибки обход прекращается
         """
-        Синхронный метод для получения данных от Cards API v4 через requests
-        Использует актуальное публичное API Wildberries card.wb.ru/cards/v4/detail
+        pending = deque()
+        next_offset = 0
+
+        def schedule_next():
+            nonlocal next_offset
+            task = asyncio.ensure_future(self.get_goods_list(limit=limit, offset=next_offset))
+            pending.append((next_offset, task))
+            next_offset += limit
+
+        # Первую страницу запрашиваем одну: у большинства продавцов она единственная
+        schedule_next()
+
+        try:
+            while pending:
+                offset, task = pending.popleft()
+                result = await task
+
+                if not result['success']:
+                    yield {
+                        'success': False,
+                        'offset': offset,
+                        'error': result['error']
+                    }
+                    return
+
+                goods = ((result['data'] or {}).get('data') or {}).get('listGoods') or []
+                yield {
+                    'success': True,
+                    'offset': offset,
+                    'goods': goods
+                }
+
+                if len(goods) < limit:
+                    return
+
+                # Страница полная - держим в работе до prefetch + 1 следующих страниц
+                while len(pending) < prefetch + 1:
+                    schedule_next()
+        finally:
+            # Отменяем заранее запрошенные страницы, если обход прерван
+            for _, task in pending:
+                task.cancel()
+
+    async def get_all_goods(self) -> Dict:
+        """
+        Получение всего списка товаров (все страницы listGoods)
+
+        Returns:
+            {'success': True, 'goods': [...], 'complete': bool} или {'success': False, 'error': str}.
+            complete = False, если одна из страниц после первой не получена.
+        """
+        goods = []
+
+        async for page in self.iter_goods_pages():
+            if not page['success']:
+                if not goods:
+                    return {
+                        'success': False,
+                        'error': page['error']
+                    }
+
+                logger.warning(
+                    f"listGoods: страница offset={page['offset']} не получена ({page['error']}), "
+                    f"получено {len(goods)} товаров"
+                )
+                return {
+                    'success': True,
+                    'goods': goods,
+                    'complete': False
+                }
+
+            goods.extend(page['goods'])
+
+        return {
+            'success': True,
+            'goods': goods,
+            'complete': True
+        }
+
+    async def get_all_goods_shared(self) -> Dict:
+        """
+        Полный список товаров через общий кэш default_goods_cache
+
+        Предназначен для дефолтных ключей: одинаковые запросы всех подписчиков
+        в пределах DEFAULT_GOODS_CACHE_TTL (и одновременные) обслуживаются
+        одним обращением к WB. Кэшируется только полностью полученный список.
+        """
+        return await default_goods_cache.get_or_load(
+            self.api_key,
+            self.get_all_goods,
+            cache_if=lambda result: result['success'] and result['complete']
+        )
+
+    async def get_cards_detail(self, nm_ids: List[int], batch_size: int = WB_CARDS_BATCH_SIZE,
+                               max_concurrency: int = WB_CARDS_MAX_CONCURRENCY) -> Dict:
+        """
+        Получение данных от Cards API v4 с разбиением на пачки
+
+        nmID делятся на пачки по batch_size, пачки запрашиваются параллельно
+        (не более max_concurrency одновременно), списки products объединяются.
+        Ошибка одной пачки теряет только её товары. Карточки, уже лежащие
+        в кэше cards_cache, по сети не запрашиваются.
+
+        Args:
+            nm_ids: список nmId товаров
+            batch_size: количество nmID в одном запросе
+            max_concurrency: максимум одновременных запросов
+
+        Returns:
+            Словарь с детальной информацией о товарах
+        """
+        # Карточки из кэша не запрашиваем повторно
+        cached_products = []
+        missing_ids = []
+        for nm_id in nm_ids:
+            card = cards_cache.get(nm_id)
+            if card is not None:
+                cached_products.append(card)
+            else:
+                missing_ids.append(nm_id)
+
+        cached_result = {
+            'success': True,
+            'data': {'products': cached_products}
+        }
+
+        if not missing_ids:
+            logger.info(f"Cards API v4: все {len(nm_ids)} товаров взяты из кэша")
+            return cached_result
+
+        batches = [missing_ids[i:i + batch_size] for i in range(0, len(missing_ids), batch_size)]
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def fetch_batch(batch: List[int]) -> Dict:
+            async with semaphore:
+                # Cards API публичный, поэтому одинаковые пачки объединяются для всех ключей
+                return await request_coalescer.run(
+                    ('cards', tuple(batch)),
+                    lambda: self._get_cards_batch(batch)
+                )
+
+        results = await asyncio.gather(*(fetch_batch(batch) for batch in batches))
+
+        for idx, (batch, result) in enumerate(zip(batches, results)):
+            if not result['success']:
+                logger.warning(f"Cards API: пачка из {len(batch)} товаров не получена: {result['error']}")
+                continue
+
+            # Сохраняем полученные карточки в кэш в компактном виде.
+            # Результат может быть общим для объединенных вызовов, поэтому не изменяем его
+            products = result['data'].get('products')
+            if products is not None:
+                products = [_compact_card(card) for card in products]
+                for card in products:
+                    if card['id']:
+                        cards_cache.set(card['id'], card)
+                results[idx] = {
+                    'success': True,
+                    'data': dict(result['data'], products=products)
+                }
+
+        if cached_products:
+            results.append(cached_result)
+
+        merged = merge_cards_results(results)
+        if merged['success']:
+            failed = len([result for result in results if not result['success']])
+            logger.info(
+                f"Cards API v4: из кэша {len(cached_products)}, пачек {len(batches)}, с ошибкой {failed}, "
+                f"товаров получено {len(merged['data'].get('products', []))}, кэш {cards_cache.get_stats()}, "
+                f"объединение запросов {request_coalescer.get_stats()}"
+            )
+
+        return merged
+
+    async def _get_cards_batch(self, nm_ids: List[int]) -> Dict:
+        """
+        Один запрос к Cards API v4 (актуальное публичное API card.wb.ru/cards/v4/detail)
+
+        Запрос выполняется асинхронно через общий пул соединений,
+        поэтому не занимает потоки executor'а.
         """
         # Используем актуальный endpoint v4
         url = 'https://card.wb.ru/cards/v4/detail'
@@ -92,11 +494,12 @@ class WildberriesAPI:
         try:
             logger.info(f"Cards API v4 запрос: {len(nm_ids)} товаров, URL: {url}")
             logger.info(f"Cards API v4 параметры: nm={nm_string[:100]}...")
-            response = requests.get(url, params=params, headers=headers, verify=False, timeout=30)
-            logger.info(f"Cards API v4 ответ: status={response.status_code}, размер={len(response.text)} байт")
+            status, response_text = await self._request(url, headers=headers, params=params,
+                                                        ssl=False, timeout=CARDS_API_TIMEOUT)
+            logger.info(f"Cards API v4 ответ: status={status}, размер={len(response_text)} байт")
 
-            if response.status_code == 200:
-                json_data = response.json()
+            if status == 200:
+                json_data = json.loads(response_text)
                 logger.info(f"Catalog API JSON ключи верхнего уровня: {list(json_data.keys())}")
 
                 # Логируем структуру для отладки
@@ -109,10 +512,10 @@ class WildberriesAPI:
                     'data': json_data
                 }
             else:
-                logger.error(f"Catalog API ошибка {response.status_code}: {response.text[:200]}")
+                logger.error(f"Catalog API ошибка {status}: {response_text[:200]}")
                 return {
                     'success': False,
-                    'error': f'HTTP {response.status_code}: {response.text[:200]}'
+                    'error': f'HTTP {status}: {response_text[:200]}'
                 }
         except Exception as e:
             logger.error(f"Catalog API exception: {str(e)}")
@@ -120,17 +523,3 @@ class WildberriesAPI:
                 'success': False,
                 'error': f'Connection error: {str(e)}'
             }
-
-    async def get_cards_detail(self, nm_ids: List[int]) -> Dict:
-        """
-        Async wrapper для получения данных от Cards API
-
-        Args:
-            nm_ids: список nmId товаров
-
-        Returns:
-            Словарь с детальной информацией о товарах
-        """
-        import asyncio
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self._get_cards_detail_sync, nm_ids)